@@ -0,0 +1,82 @@
+'''
+    import time and first simulation latency of wrdice, each measured in a fresh interpreter
+        python benchmarks/import_time.py [--repeat 7] [--budget-ms 250]
+    budgets apply to the time on top of importing numpy, which wrdice can not avoid
+    exits with 1 if the median of a budgeted target exceeds it
+'''
+import argparse
+import os
+import subprocess
+import sys
+from statistics import median
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = {
+    'python': '',
+    'numpy': 'import numpy',
+    'import wrdice': 'import wrdice',
+    'import wrdice.Simulate': 'import wrdice.Simulate',
+    'first simulation': '''
+from wrdice.Army import Army
+from wrdice.Simulate import Simulate
+from wrdice.config import wr20_vaniilla_options as config
+from wrdice.util import CombatSystem, Backend
+A = Army([5, 2, 3, 0, 0], [0, 0, 3, 0, 0], [0] * 5, config)
+B = Army([5, 3, 2, 0, 0], [0, 0, 4, 1, 0], [0] * 5, config)
+A.apply_stance([[-1, 0, -1, 0, 0], [0, -1, 0, 0, 0]], [[0] * 5, [-1] * 5], [[-1] * 5, [0] * 5])
+B.apply_stance([[-1, 0, -1, 0, 0], [0, -1, 0, 0, 0]], [[0] * 5, [-1] * 5], [[0] * 5, [-1] * 5])
+sim = Simulate(A, B, config)
+sim.N = 500
+sim.run(CombatSystem.WarRoomV2, config=config, backend=Backend.Vectorized, seed=0)
+''',
+}
+
+BUDGETED = ['import wrdice.Simulate', 'first simulation']
+
+TIMER = '''
+import time
+t0 = time.perf_counter()
+exec(compile({code!r}, '<bench>', 'exec'))
+print(time.perf_counter() - t0)
+'''
+
+
+def measure(code: str, repeat: int) -> list:
+    ''' seconds spent in code, once per fresh interpreter '''
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', TIMER.format(code=code)], env=env, cwd=ROOT,
+                             check=True, capture_output=True, text=True).stdout
+        times.append(float(out.strip().splitlines()[-1]))
+    return times
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--budget-ms', type=float, default=None,
+                        help='fail if import wrdice.Simulate or the first simulation take longer than '
+                             'numpy + budget (median, ms)')
+    args = parser.parse_args(argv)
+
+    status = 0
+    baseline = 0
+    for name, code in TARGETS.items():
+        ms = median(measure(code, args.repeat)) * 1000
+        if name == 'numpy':
+            baseline = ms
+        line = f'{name:<24} {ms:8.1f} ms'
+        if name in BUDGETED:
+            line += f'   (+{ms - baseline:.1f} ms over numpy)'
+            if args.budget_ms is not None and ms - baseline > args.budget_ms:
+                line += '   over budget'
+                status = 1
+        print(line)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
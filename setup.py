@@ -23,8 +23,8 @@ setup(name='WRDice',
       url='',
       packages=['wrdice'],
       install_requires=['numpy', 
-                        'tqdm',
                         ],
+      extras_require={'progress': ['tqdm']},
       classifiers=[
           'Development Status :: 1 - Planning',
           'Intended Audience :: Developers',
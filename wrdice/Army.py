@@ -1,40 +1,78 @@
-from more_itertools import factor
 import numpy as np
 import logging
-import copy
 from wrdice.util import ListToNumpy, Strategy, STANCE, COLOR
+from wrdice.CombatConfig import CombatConfig
 
 class Army:
+    '''
+        all unit counts live in one contiguous int16 buffer
+            units[type]           (color)         buffer[0:15]
+            units_by_stance[type] (stance, color) buffer[15:45]
+            units_hp[type]        (color, stance) buffer[45:75]
+        the dicts only hold named views into it, so they have to be updated in place
+    '''
+    __slots__ = ('buffer', 'units', 'units_by_stance', 'units_hp', 'submerged',
+                 'strategy', 'options', 'n_dice_air', 'n_dice_ground')
+
     def __init__(self, units_land, units_air, units_sea, options):
-        self.units = {'land' : ListToNumpy(units_land),
-                       'sea' : ListToNumpy(units_sea),
-                       'air' : ListToNumpy(units_air)}
+        self.buffer = np.zeros(75, dtype=np.int16)
+        self.bind_views()
+        self.units['land'][:] = ListToNumpy(units_land)
+        self.units['sea'][:] = ListToNumpy(units_sea)
+        self.units['air'][:] = ListToNumpy(units_air)
 
         self.submerged = 0
 
-        self.units_by_stance = None
-
-        self.units_hp = {}
         self.strategy = {'air' :    None,
                          'ground' : None}
 
-        self.options = options
+        self.options = CombatConfig.compile(options)
         self.n_dice_air = 0
         self.n_dice_ground = 0
-        
+
+
+    def bind_views(self):
+        types = ['land', 'sea', 'air']
+        units = self.buffer[0:15].reshape(3, 5)
+        units_by_stance = self.buffer[15:45].reshape(3, 2, 5)
+        units_hp = self.buffer[45:75].reshape(3, 5, 2)
+        self.units = {T: units[i] for i, T in enumerate(types)}
+        self.units_by_stance = {T: units_by_stance[i] for i, T in enumerate(types)}
+        self.units_hp = {T: units_hp[i] for i, T in enumerate(types)}
+
+    def __getstate__(self):
+        return (self.buffer, self.submerged, self.strategy, self.options, self.n_dice_air, self.n_dice_ground)
+
+    def __setstate__(self, state):
+        self.buffer, self.submerged, self.strategy, self.options, self.n_dice_air, self.n_dice_ground = state
+        self.bind_views()
 
     def __copy__(self):
         cls = self.__class__
         result = cls.__new__(cls)
-        result.units = self.units.copy()
+        result.buffer = self.buffer.copy()
+        result.bind_views()
         result.submerged = 0
-        result.units_by_stance = copy.deepcopy(self.units_by_stance)
         result.n_dice_air = self.n_dice_air 
         result.n_dice_ground = self.n_dice_ground
-        result.units_hp = copy.deepcopy(self.units_hp)
         result.strategy = self.strategy
         result.options = self.options
         return result
+
+    def snapshot(self):
+        '''
+            state of the army as one flat int array (unit buffer, submerged and dice)
+            and the strategy - reset to it with restore
+        '''
+        state = np.concatenate((self.buffer, [self.submerged, self.n_dice_air, self.n_dice_ground]))
+        return state, dict(self.strategy)
+
+    def restore(self, snapshot):
+        ''' resets the army to a snapshot with a single copy into its buffer '''
+        state, strategy = snapshot
+        np.copyto(self.buffer, state[:-3])
+        self.submerged, self.n_dice_air, self.n_dice_ground = (int(x) for x in state[-3:])
+        self.strategy.update(strategy)
     
     def calc_priorization_yuan_ming(self):
         ''' Algo by Yuan Ming @shadowymz -> boardgamegeek.com
@@ -68,28 +106,38 @@ class Army:
         return np.concatenate((factor_land, factor_sea),axis=0)
             
     
-    def get_ground_target_priority(self):
+    def get_ground_target_priority(self, strategy=None):
         '''
         returns a priority table - shape 5 - 4
         for each color (till black)
         axis 2 - combined land and sea (both ground) with 2 positions for each stance assignment
         contains the priority 0-low to 19-high for each unit
+        strategy defaults to the ground strategy of the army
         '''
-        if self.strategy['ground'] == Strategy.BlackToHighestValueFirst:
-            prio_land = np.argsort(self.options['unit_cost_equiv']['land']) * 2 # len 5 
-            prio_land_2 = np.argsort(self.options['unit_cost_equiv']['land']) * 2 + 1 # len 5 
-            prio_land = np.stack((prio_land, prio_land_2), axis=1)
-            
-            prio_sea  = np.argsort(self.options['unit_cost_equiv']['sea']) *2  +10
-            prio_sea_2  = np.argsort(self.options['unit_cost_equiv']['sea']) *2 +11
-            prio_sea = np.stack((prio_sea, prio_sea_2), axis=1)
-            prio = np.concatenate((prio_land, prio_sea),axis=1).T
-        elif self.strategy['ground'] == Strategy.ShadowywzsStrategy:
+        if strategy is None:
+            strategy = self.strategy['ground']
+        if strategy == Strategy.BlackToHighestValueFirst:
+            # by unit cost - precomputed by the config
+            prio = self.options.ground_target_priority[strategy]
+        elif strategy == Strategy.ShadowywzsStrategy:
             prio = self.calc_priorization_yuan_ming()
         return prio
 
+    def get_ground_target_order(self, strategy=None):
+        '''
+            (color, stance) indices into the combined ground hp pool (see get_ground_target_priority)
+            in the order black and white dice are assigned to them
+        '''
+        if strategy is None:
+            strategy = self.strategy['ground']
+        if strategy in self.options.ground_target_order:
+            return self.options.ground_target_order[strategy]
+        priority = self.get_ground_target_priority(strategy)
+        stance_idx, color_idx = np.unravel_index(np.argsort(priority, axis=None), priority.shape)
+        return color_idx, stance_idx
+
     def set_config(self, config):
-        self.options = config
+        self.options = CombatConfig.compile(config)
     
     def set_strategy(self, air_strategy: Strategy, ground_strategy: Strategy) -> None:
         self.strategy['air'] = air_strategy
@@ -120,10 +168,9 @@ class Army:
         stance_land = ListToNumpy(stance_land)
         stance_sea = ListToNumpy(stance_sea)
 
-        self.units_by_stance = {}
-        self.units_by_stance['air'] = stance_air
-        self.units_by_stance['land'] = stance_land
-        self.units_by_stance['sea'] = stance_sea
+        self.units_by_stance['air'][:] = stance_air
+        self.units_by_stance['land'][:] = stance_land
+        self.units_by_stance['sea'][:] = stance_sea
 
         # check that the number of troops over all stances are not more than we have to deploy
         count_units_land = np.sum(stance_land, 0)
@@ -153,23 +200,8 @@ class Army:
                                 Units total sea {self.units["sea"]}\n\
                                 SEA units assigned to stances {count_units_sea}')
         
-        self.n_dice_air = []
-        self.n_dice_air.append(stance_land[STANCE.AIR] * self.options['unit_attack']['land'][STANCE.AIR][0])
-        self.n_dice_air.append(stance_land[STANCE.GROUND] * self.options['unit_attack']['land'][STANCE.GROUND][0])
-        self.n_dice_air.append(stance_sea[STANCE.AIR] * self.options['unit_attack']['sea'][STANCE.AIR][0])
-        self.n_dice_air.append(stance_sea[STANCE.GROUND] * self.options['unit_attack']['sea'][STANCE.GROUND][0])
-        self.n_dice_air.append(stance_air[STANCE.AIR] * self.options['unit_attack']['air'][STANCE.AIR][0])
-        self.n_dice_air.append(stance_air[STANCE.GROUND] * self.options['unit_attack']['air'][STANCE.GROUND][0])
-        self.n_dice_air = np.sum(self.n_dice_air).astype(int)
-
-
-        self.n_dice_ground = []
-        self.n_dice_ground.append(stance_land[STANCE.GROUND] * self.options['unit_attack']['land'][STANCE.GROUND][1])
-        self.n_dice_ground.append(stance_land[STANCE.AIR] * self.options['unit_attack']['land'][STANCE.AIR][1])
-        self.n_dice_ground.append(stance_sea[STANCE.AIR] * self.options['unit_attack']['sea'][STANCE.AIR][1])
-        self.n_dice_ground.append(stance_sea[STANCE.GROUND] * self.options['unit_attack']['sea'][STANCE.GROUND][1])
-        self.n_dice_ground.append(stance_air[STANCE.GROUND] * self.options['unit_attack']['air'][STANCE.GROUND][1])
-        self.n_dice_ground = np.sum(self.n_dice_ground).astype(int)
+        self.n_dice_air = self.count_dice(self.options.dice_air)
+        self.n_dice_ground = self.count_dice(self.options.dice_ground)
 
         if self.options['cap_total_dice']:
             self.n_dice_ground = np.minimum(self.n_dice_ground, self.options['cap_total_dice_limit'])
@@ -184,18 +216,15 @@ class Army:
             return unit_hp.reshape(2,-1).T
  
         # create HP pool
-        self.units_hp['air'] = create_hp_pool('air')
-        self.units_hp['land'] = create_hp_pool('land')
-        self.units_hp['sea'] = create_hp_pool('sea')
+        self.units_hp['air'][:] = create_hp_pool('air')
+        self.units_hp['land'][:] = create_hp_pool('land')
+        self.units_hp['sea'][:] = create_hp_pool('sea')
 
 
     
-    def update_dice_ground(self):
-        self.n_dice_ground = []
-        self.n_dice_ground.append(self.units_by_stance['land'][STANCE.GROUND] * self.options['unit_attack']['land'][STANCE.GROUND][1])
-        self.n_dice_ground.append(self.units_by_stance['land'][STANCE.AIR] * self.options['unit_attack']['land'][STANCE.AIR][1])
-        self.n_dice_ground.append(self.units_by_stance['sea'][STANCE.AIR] * self.options['unit_attack']['sea'][STANCE.AIR][1])
-        self.n_dice_ground.append(self.units_by_stance['sea'][STANCE.GROUND] * self.options['unit_attack']['sea'][STANCE.GROUND][1])
-        self.n_dice_ground.append(self.units_by_stance['air'][STANCE.GROUND] * self.options['unit_attack']['air'][STANCE.GROUND][1])
-        self.n_dice_ground = np.sum(self.n_dice_ground).astype(int)
+    def count_dice(self, dice_per_unit):
+        ''' dice of all units with dice_per_unit[type][stance][color] '''
+        return int(sum((self.units_by_stance[T] * dice_per_unit[T]).sum() for T in ['land', 'sea', 'air']))
 
+    def update_dice_ground(self):
+        self.n_dice_ground = self.count_dice(self.options.dice_ground)
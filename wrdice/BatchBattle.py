@@ -0,0 +1,426 @@
+from wrdice.Army import Army
+from wrdice.CombatConfig import CombatConfig
+from wrdice.D12Colored import D12Colored
+from wrdice.Profiler import NO_PROFILER
+from wrdice.util import *
+
+import numpy as np
+import logging
+
+
+class BatchBattle:
+    '''
+        Runs n independent battles of the same matchup at once.
+        Follows the phases of Battle.run_warroomv2 and Battle.run_quickbattle but
+        keeps the state of all trials in arrays with a leading trial axis:
+            units_hp[side][type]        (n, color, stance)
+            units_by_stance[side][type] (n, stance, color)
+            units[side][type]           (n, color)
+        every batch of dice is rolled for all trials with a single call
+        dice (see draw_dice) replays pre-drawn faces instead of rolling
+        dice_p are the face probabilities the dice were drawn from if they differ from
+        the die, for both sides or {side: p} - every trial is then weighted by its
+        likelihood ratio (weights)
+        profiler collects phase times and counters summed over all trials, see Profiler
+    '''
+    # every roll of a battle - (phase, source, batch)
+    ROLL_SLOTS = [(phase, source, batch) for phase in ['air', 'ground'] for batch in range(3) for source in ['A', 'B']]
+
+    def __init__(self, army_a: Army, army_b: Army, options, n: int, rng=None, dice=None, dice_p=None, profiler=None):
+        self.army = {'A' : army_a,
+                     'B' : army_b}
+        self.options = CombatConfig.compile(options)
+        self.n = n
+        self.d12_batch = D12Colored(options['batch_size'], rng)
+        self.dice = dice
+        # log likelihood ratio of each face per rolling side
+        self.log_ratio = {side: None if p is None else np.log(self.d12_batch.p / np.asarray(p))
+                          for side, p in self.per_side(dice_p).items()}
+        self.log_weight = np.zeros(n)
+        self.battle_ground = None
+        self.profiler = NO_PROFILER if profiler is None else profiler
+
+        self.units = {}
+        self.units_by_stance = {}
+        self.units_hp = {}
+        self.submerged = {}
+        self.n_dice_air = {}
+        self.n_dice_ground = {}
+        # per trial flags
+        self.fa = {}
+        self.strategy_set = {}
+
+        for side, army in self.army.items():
+            self.units[side] = {T: np.repeat(army.units[T][None, :].astype(int), n, axis=0)
+                                    for T in ['land', 'sea', 'air']}
+            self.units_by_stance[side] = {T: np.repeat(army.units_by_stance[T][None, :].astype(int), n, axis=0)
+                                              for T in ['land', 'sea', 'air']}
+            self.units_hp[side] = {T: np.repeat(army.units_hp[T][None, :].astype(int), n, axis=0)
+                                       for T in ['land', 'sea', 'air']}
+            self.submerged[side] = np.zeros(n, dtype=int)
+            self.n_dice_air[side] = int(army.n_dice_air)
+            self.n_dice_ground[side] = np.full(n, army.n_dice_ground, dtype=int)
+            self.fa[side] = np.ones(n, dtype=bool)
+            self.strategy_set[side] = np.full(n, army.strategy['ground'] == Strategy.BlackToHighestValueFirst)
+
+
+    def get_num_colors_land(self, side):
+        return (self.units[side]['land'] > 0).sum(axis=1)
+
+
+    def get_force_advantage(self):
+        num_colors_a = self.get_num_colors_land('A')
+        num_colors_b = self.get_num_colors_land('B')
+        return {'A': num_colors_a >= num_colors_b,
+                'B': num_colors_b >= num_colors_a}
+
+
+    def get_ground_target_order(self, target):
+        strategy = self.army[target].strategy['ground']
+        if strategy is None:
+            strategy = Strategy.BlackToHighestValueFirst
+        return self.army[target].get_ground_target_order(strategy)
+
+
+    @staticmethod
+    def per_side(p):
+        ''' face probabilities for both sides or {side: p} -> {side: p or None} '''
+        if isinstance(p, dict):
+            return {side: p.get(side) for side in ['A', 'B']}
+        return {'A': p, 'B': p}
+
+
+    @staticmethod
+    def draw_dice(d12_batch: D12Colored, n: int, batch_size: int, sampler: Sampler = Sampler.MonteCarlo, p=None):
+        ''' faces of every die of every roll slot of n trials - {slot: (trial, die)}
+            p - face probabilities to draw from, see dice_p
+        '''
+        p = BatchBattle.per_side(p)
+        dice = {}
+        for slot in BatchBattle.ROLL_SLOTS:
+            if sampler == Sampler.Stratified and slot[2] == 0:
+                dice[slot] = d12_batch.draw_stratified_faces(n, batch_size)
+            else:
+                dice[slot] = d12_batch.draw_faces((n, batch_size), sampler, p[slot[1]])
+        return dice
+
+
+    def roll_dice(self, n_dice, slot=None):
+        ''' one roll per trial - n_dice[trial] -> roll[trial, face] '''
+        if self.profiler:
+            self.profiler.count('rolls', np.count_nonzero(n_dice))
+            self.profiler.count('dice', np.sum(n_dice))
+        if self.dice is not None:
+            faces = self.dice[slot]
+            log_ratio = self.log_ratio[slot[1]]
+            if log_ratio is not None:
+                used = np.arange(faces.shape[1]) < np.asarray(n_dice)[:, None]
+                self.log_weight += np.where(used, log_ratio[faces], 0).sum(axis=1)
+            return self.d12_batch.count_faces(faces, n_dice)
+        return self.d12_batch.roll_many(n_dice)
+
+
+    @property
+    def weights(self) -> np.ndarray:
+        ''' likelihood ratio of each trial - all 1 unless the dice were drawn from dice_p '''
+        return np.exp(self.log_weight)
+
+
+    def roll_air_and_apply_hits_wr2(self, source, target, batch):
+        dice = min(self.options['batch_size'], self.n_dice_air[source])
+        self.n_dice_air[source] = max(0, self.n_dice_air[source] - self.options['batch_size'])
+        if dice == 0:
+            return
+
+        roll = self.roll_dice(np.full(self.n, dice), ('air', source, batch))
+        if self.profiler:
+            before = self.profiler.total(self.units_hp[target])
+
+        air_hp = self.units_hp[target]['air']
+        hits_green = roll[:, COLOR.GREEN]
+        # red hits only land if green hit as well
+        hits_red = np.where(hits_green > 0, roll[:, COLOR.RED], 0)
+
+        # stance 1 takes the damage first
+        for color, hits in [(COLOR.GREEN, hits_green), (COLOR.RED, hits_red)]:
+            pool, _ = drain_hits(air_hp[:, color, ::-1], hits)
+            air_hp[:, color, :] = pool[:, ::-1]
+
+        if self.army[source].strategy['air'] == Strategy.BlackToHighestValueFirst:
+            # black hits any plane, white only finishes off damaged ones
+            unit_hp = self.options.hp_air
+            color_idx = np.array([COLOR.RED, COLOR.RED, COLOR.GREEN, COLOR.GREEN])
+            stance_idx = np.array([1, 0, 1, 0])
+
+            air_hp[:, color_idx, stance_idx], _ = drain_hits(air_hp[:, color_idx, stance_idx], roll[:, COLOR.BLACK])
+            air_hp[:, color_idx, stance_idx], _ = drain_damaged_hits(air_hp[:, color_idx, stance_idx], roll[:, COLOR.WHITE],
+                                                                     unit_hp[color_idx, stance_idx])
+
+        if self.profiler:
+            self.profiler.count('hits', before - self.profiler.total(self.units_hp[target]))
+
+
+    def roll_ground_and_apply_hits_wr2(self, source, target, batch):
+        dice = np.minimum(self.options['batch_size'], self.n_dice_ground[source])
+        self.n_dice_ground[source] = np.maximum(0, self.n_dice_ground[source] - self.options['batch_size'])
+        active = dice > 0
+        if not active.any():
+            return
+
+        roll = self.roll_dice(dice, ('ground', source, batch))
+        hits_ground = roll.copy()
+        if self.profiler:
+            before = self.profiler.total(self.units_hp[target])
+
+        ground_hp = np.concatenate((self.units_hp[target]['land'],
+                                    self.units_hp[target]['sea']), axis=2)
+
+        # same target order as Battle.roll_ground_and_apply_hits_wr2
+        escort = self.battle_ground == 'sea'
+        for color in [COLOR.YELLOW, COLOR.BLUE, COLOR.GREEN, COLOR.RED]:
+            order = self.options.ground_hit_order[color]
+            if escort and color in [COLOR.GREEN, COLOR.RED]:
+                for p in order:
+                    ground_hp[:, color, p], ground_hp[:, COLOR.BLUE, 2], hits_ground[:, color] = \
+                        drain_escorted_hits(ground_hp[:, color, p], hits_ground[:, color],
+                                            ground_hp[:, COLOR.BLUE, 2], self.options['hp']['sea'][0][color])
+            else:
+                pool, hits_ground[:, color] = drain_hits(ground_hp[:, color, order], hits_ground[:, color])
+                ground_hp[:, color, order] = pool
+
+        # a side without a strategy falls back to highest value first once it is targeted
+        if self.army[target].strategy['ground'] is None:
+            self.strategy_set[target] |= active
+
+        wild = self.fa[source] & self.strategy_set[source]
+        if wild.any():
+            color_idx, stance_idx = self.get_ground_target_order(target)
+            hits = np.where(wild, hits_ground[:, COLOR.BLACK] + hits_ground[:, COLOR.WHITE], 0)
+            pool, _ = drain_hits(ground_hp[:, color_idx, stance_idx], hits)
+            ground_hp[:, color_idx, stance_idx] = pool
+
+        # write back updated hp pool
+        self.units_hp[target]['land'] = ground_hp[:, :, :2]
+        self.units_hp[target]['sea'] = ground_hp[:, :, 2:]
+
+        if self.profiler:
+            self.profiler.count('hits', before - self.profiler.total(self.units_hp[target]))
+
+
+    def expected_hits(self, source, target):
+        ''' hits a batch is expected to score on each color of target - (n, color) '''
+        P = self.d12_batch.p[:COLOR.WHITE] + np.where(self.fa[source], self.d12_batch.p[COLOR.WHITE], 0)[:, None]
+        unit_hp = self.options['hp'][self.battle_ground][0]
+        mu = np.floor_divide(P * self.options['batch_size'], unit_hp, out=np.zeros_like(P), where=unit_hp != 0)
+        return np.minimum(self.units[target][self.battle_ground], mu)
+
+
+    def apply_color_selection(self, source, target, hits):
+        ''' same selection as Battle.apply_color_selection for every trial '''
+        if not self.options['color_select']:
+            return hits
+
+        num_colors = (self.units[source][self.battle_ground] > 0).sum(axis=1)
+        drop = color_selection_mask(self.options['color_select_strategy'], self.expected_hits(source, target),
+                                    self.units[target][self.battle_ground], num_colors,
+                                    np.asarray(self.options['morale'][self.battle_ground]))
+        return np.where(drop, 0, hits)
+
+
+    def roll_air_and_apply_hits_wr2qb(self, source, target, batch):
+        dice = min(self.options['batch_size'], self.n_dice_air[source])
+        self.n_dice_air[source] = max(0, self.n_dice_air[source] - self.options['batch_size'])
+        if dice == 0:
+            return
+
+        roll = self.roll_dice(np.full(self.n, dice), ('air', source, batch))
+        if self.profiler:
+            before = self.profiler.total(self.units[target])
+
+        # quickbattle counts units - no hp pools, planes use the hp of stance 0
+        hits, unmatched, wild = split_quick_hits(roll, self.options['hp']['air'][0])
+        self.units[target]['air'] = np.maximum(self.units[target]['air'] - hits, 0)
+        # the wild dice of the air phase go to the land units
+        self.units[target]['land'] = apply_wild_hit(self.units[target]['land'], unmatched, wild)
+
+        if self.profiler:
+            self.profiler.count('hits', before - self.profiler.total(self.units[target]))
+
+
+    def roll_ground_and_apply_hits_wr2qb(self, source, target, batch):
+        dice = np.minimum(self.options['batch_size'], self.n_dice_ground[source])
+        self.n_dice_ground[source] = np.maximum(0, self.n_dice_ground[source] - self.options['batch_size'])
+        if not (dice > 0).any():
+            return
+
+        roll = self.roll_dice(dice, ('ground', source, batch))
+        if self.profiler:
+            before = self.profiler.total(self.units[target])
+
+        hits, unmatched, wild = split_quick_hits(roll, self.options['hp'][self.battle_ground][0])
+        hits = self.apply_color_selection(source, target, hits)
+        units = np.maximum(self.units[target][self.battle_ground] - hits, 0)
+        if self.options['force_advantage']:
+            # remaining dice go to the highest valued unit
+            wild = np.where(self.fa[source], wild, 0)
+        self.units[target][self.battle_ground] = apply_wild_hit(units, unmatched, wild)
+
+        if self.profiler:
+            self.profiler.count('hits', before - self.profiler.total(self.units[target]))
+
+
+    def update_unit_count(self, target):
+        for type in ['air', self.battle_ground]:
+            unit_hp = self.options['hp'][type].T
+            in_battle = np.zeros_like(self.units_hp[target][type])
+            np.floor_divide(self.units_hp[target][type] + unit_hp - 1, unit_hp,
+                            out=in_battle, where=unit_hp != 0)
+
+            self.units_by_stance[target][type] = in_battle.transpose(0, 2, 1).copy()
+            self.units[target][type] = in_battle.sum(axis=2)
+
+        self.units[target]['sea'][:, 0] += self.submerged[target]
+        self.units_by_stance[target]['sea'][:, 0, 0] += self.submerged[target]
+
+
+    def check_submerged(self, target):
+        sub_hp = self.options['hp']['sea'][:, 0]
+        sub_cur_hp = self.units_hp[target]['sea'][:, 0, :]
+
+        flee = np.zeros(sub_cur_hp.shape, dtype=bool)
+        np.equal(np.mod(sub_cur_hp, sub_hp, where=sub_hp != 0, out=np.zeros_like(sub_cur_hp)), 1,
+                 out=flee, where=sub_hp != 0)
+
+        self.submerged[target] += flee.any(axis=1)
+        self.units_hp[target]['sea'][:, 0, :] -= flee
+
+
+    def update_dice_ground(self, side):
+        ubs = self.units_by_stance[side]
+        self.n_dice_ground[side] = sum(np.einsum('nsc,sc->n', ubs[T], self.options.dice_ground[T])
+                                       for T in ['land', 'sea', 'air']).astype(int)
+
+
+    def check_batch_cap(self):
+        count_a = self.get_num_colors_land('A')
+        count_b = self.get_num_colors_land('B')
+
+        cap_b = (3 - (count_a - count_b)) * self.options['batch_size']
+        cap_a = (3 - (count_b - count_a)) * self.options['batch_size']
+        self.n_dice_ground['B'] = np.where(count_a > count_b, np.minimum(self.n_dice_ground['B'], cap_b), self.n_dice_ground['B'])
+        self.n_dice_ground['A'] = np.where(count_b > count_a, np.minimum(self.n_dice_ground['A'], cap_a), self.n_dice_ground['A'])
+
+
+    def check_batch_cap_arewethebaddies(self):
+        # every color more than the enemy costs the enemy a batch - at least one is left
+        count_a = self.get_num_colors_land('A')
+        count_b = self.get_num_colors_land('B')
+
+        for side, diff in [('B', count_a - count_b), ('A', count_b - count_a)]:
+            n_dice = self.n_dice_ground[side]
+            capped = np.maximum(n_dice - diff * self.options['batch_size'], np.minimum(n_dice, self.options['batch_size']))
+            self.n_dice_ground[side] = np.where(diff > 0, capped, n_dice)
+
+
+    def run_warroomv2(self):
+        if self.options['force_advantage']:
+            self.fa = self.get_force_advantage()
+
+        with self.profiler.phase('air'):
+            for batch in range(3):
+                self.roll_air_and_apply_hits_wr2('A', 'B', batch)
+                self.roll_air_and_apply_hits_wr2('B', 'A', batch)
+
+        with self.profiler.phase('update_unit_count'):
+            self.update_unit_count('A')
+            self.update_unit_count('B')
+
+        # update land combat strenght
+        self.update_dice_ground('A')
+        self.update_dice_ground('B')
+
+        if self.options['batch_cap']:
+            self.check_batch_cap()
+
+        for batch in range(3):
+            with self.profiler.phase('ground'):
+                self.roll_ground_and_apply_hits_wr2('A', 'B', batch)
+                self.roll_ground_and_apply_hits_wr2('B', 'A', batch)
+
+                if self.options['recheck_force_advantage']:
+                    self.fa = self.get_force_advantage()
+
+            if self.battle_ground == 'sea':
+                with self.profiler.phase('check_submerged'):
+                    self.check_submerged('A')
+                    self.check_submerged('B')
+
+        with self.profiler.phase('update_unit_count'):
+            self.update_unit_count('A')
+            self.update_unit_count('B')
+
+
+    def run_quickbattle(self):
+        ''' air and ground batches on unit counts - WarRoomV2Quickbattle and AreWeTheBaddies '''
+        if self.options['force_advantage']:
+            self.fa = self.get_force_advantage()
+
+        with self.profiler.phase('air'):
+            for batch in range(3):
+                self.roll_air_and_apply_hits_wr2qb('A', 'B', batch)
+                self.roll_air_and_apply_hits_wr2qb('B', 'A', batch)
+
+        with self.profiler.phase('ground'):
+            for batch in range(3):
+                self.roll_ground_and_apply_hits_wr2qb('A', 'B', batch)
+                self.roll_ground_and_apply_hits_wr2qb('B', 'A', batch)
+
+                if self.options['recheck_force_advantage']:
+                    self.fa = self.get_force_advantage()
+
+
+    def run_warroomv2_quickbattle(self):
+        # units are counted, not pooled - the batch cap applies to the armies as deployed
+        if self.options['batch_cap']:
+            self.check_batch_cap()
+        self.run_quickbattle()
+
+
+    def run_arewethebaddies(self):
+        if self.options['batch_cap']:
+            self.check_batch_cap_arewethebaddies()
+        self.run_quickbattle()
+
+
+    def run(self, combat_system: CombatSystem = CombatSystem.WarRoomV2) -> np.ndarray:
+        '''
+            returncode for each trial
+            0 - A lost
+            1 - B lost
+            2 - draw both survived
+            3 - draw both eliminated
+        '''
+        # auto determine battle type by units present
+        self.battle_ground = 'land'
+        for A in ['A','B']:
+            for T in ['land', 'sea']:
+                if self.army[A].units[T].sum() > 0:
+                    self.battle_ground = T
+
+        if combat_system == CombatSystem.WarRoomV2:
+            self.run_warroomv2()
+        elif combat_system == CombatSystem.WarRoomV2Quickbattle:
+            self.run_warroomv2_quickbattle()
+        elif combat_system == CombatSystem.AreWeTheBaddies:
+            self.run_arewethebaddies()
+        else:
+            raise NotImplementedError(f"{combat_system} is not supported by the vectorized backend")
+
+        alive_a = self.units['A'][self.battle_ground].sum(axis=1) > 0
+        alive_b = self.units['B'][self.battle_ground].sum(axis=1) > 0
+
+        status = np.full(self.n, 3)
+        status[~alive_a & alive_b] = 0
+        status[alive_a & ~alive_b] = 1
+        status[alive_a & alive_b] = 2
+        return status
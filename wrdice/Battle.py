@@ -1,6 +1,7 @@
-from pygments import highlight
 from wrdice.Army import Army
+from wrdice.CombatConfig import CombatConfig
 from wrdice.D12Colored import D12Colored
+from wrdice.Profiler import NO_PROFILER
 from wrdice.util import *
 
 import numpy as np
@@ -8,14 +9,16 @@ import os
 import logging
 
 class Battle:
-    def __init__(self, army_a: Army, army_b: Army, options):
+    def __init__(self, army_a: Army, army_b: Army, options, rng=None, profiler=None):
         self.army = {'A' : army_a, 
                      'B' : army_b}
-        self.options = options
-        self.d12_batch = D12Colored(options['batch_size'])
+        self.options = CombatConfig.compile(options)
+        self.d12_batch = D12Colored(options['batch_size'], rng)
         self.fa = ['A', 'B'] #both side have black and white
         self.battle_ground = None
         self.battle_air = None
+        # phase times and counters, see Profiler
+        self.profiler = NO_PROFILER if profiler is None else profiler
         logging.basicConfig(level=logging.INFO)
 
         
@@ -45,12 +48,13 @@ class Battle:
 
 
     def expected_hits(self, source, target):
-        P = self.d12_batch.p[:5]
+        P = self.d12_batch.p[:COLOR.WHITE]
 
         if source in self.fa:
-            P = P + self.d12_batch.p[5]
-        mu = (P * self.options['batch_size']) // self.options['hp']['land']
-        exp = np.minimum(self.army[target].units['land'], mu)
+            P = P + self.d12_batch.p[COLOR.WHITE]
+        unit_hp = self.options['hp'][self.battle_ground][0]
+        mu = np.floor_divide(P * self.options['batch_size'], unit_hp, out=np.zeros(len(P)), where=unit_hp != 0)
+        exp = np.minimum(self.army[target].units[self.battle_ground], mu)
         return exp
 
 
@@ -60,34 +64,11 @@ class Battle:
             return hits
 
         # we can only select as much enemy colors as target as we bring into the fight
-        num_colors = self.get_num_colors_land(source)
-        if self.options['color_select_strategy'] == ColorSelectionStrategy.MAX_NUM_HITS_FIRST:
-            exp = self.expected_hits(source, target)
-            # select the num_colors colors with the most units to hit realisticly 
-            # as we later use the indexes to clear the hits we are interested in the rest
-            color_select_to_delete = np.argsort(exp)[::-1][-num_colors:]
-
-        elif self.options['color_select_strategy'] == ColorSelectionStrategy.MAX_MORALE_LOST_FIRST:
-            exp = self.expected_hits(source, target)
-            exp *= self.options['unit_morale_land']
-            color_select_to_delete = np.argsort(exp)[::-1][:num_colors]
-
-        elif self.options['color_select_strategy'] == ColorSelectionStrategy.MAX_COLOR_REDUCTION_FIRST:
-            exp = self.expected_hits(source, target)
-            exp_after = self.army[target].units['land'] - exp
-            color_select = np.argwhere(np.logical_and(exp_after<=0, self.army[target].units['land']>0))
-            color_select_to_delete = np.delete(np.arange(5), color_select)
-            if len(color_select) == 0:
-                # we cannot reduce one color directly... fallback to MAX_MORALE
-                exp = self.expected_hits(source, target)
-                exp *= self.options['unit_morale_land']
-                color_select_to_delete = np.argsort(exp)[::-1][:num_colors]
-            
-
-
-        #apply color selection to hits_land
-        hits[color_select_to_delete] = 0
-        return hits
+        num_colors = (self.army[source].units[self.battle_ground] > 0).sum()
+        drop = color_selection_mask(self.options['color_select_strategy'], self.expected_hits(source, target),
+                                    self.army[target].units[self.battle_ground], num_colors,
+                                    np.asarray(self.options['morale'][self.battle_ground]))
+        return np.where(drop, 0, hits)
 
 
 
@@ -99,61 +80,34 @@ class Battle:
             return
 
         roll = self.d12_batch.roll(dice)
-
+        if self.profiler:
+            self.profiler.count('rolls')
+            self.profiler.count('dice', dice)
+            before = self.profiler.total(self.army[target].units_hp)
 
         # get hp pools for planes
-        hits_air = np.zeros(COLOR.BLACK)
-        hits_air[:COLOR.BLACK] = roll[:COLOR.BLACK]
-
-
         air_hp = self.army[target].units_hp['air']
-        priority = np.arange(len(air_hp.reshape(-1))).reshape(-1,2)
 
-        for color in [COLOR.GREEN, COLOR.RED]:
-            if hits_air[color] == 0:
-                break
-            for p in np.argsort(priority[color])[::-1]:
-                if hits_air[color] == 0:
-                    break
-                while air_hp[color][p] > 0 and hits_air[color] > 0:
-                    air_hp[color][p] -= 1
-                    hits_air[color] -= 1
-                    if hits_air[color] == 0:
-                        break
+        # red hits only land if green hit as well
+        hits_green = roll[COLOR.GREEN]
+        hits_red = roll[COLOR.RED] if hits_green > 0 else 0
 
+        # stance 1 takes the damage first
+        air_hp[COLOR.GREEN, ::-1], _ = drain_hits(air_hp[COLOR.GREEN, ::-1], hits_green)
+        air_hp[COLOR.RED, ::-1], _ = drain_hits(air_hp[COLOR.RED, ::-1], hits_red)
 
         if self.army[source].strategy['air'] == Strategy.BlackToHighestValueFirst:
-            priority = np.argsort(self.options['unit_morale_air'])[::-1]
-            p2 = priority*2+1
-            priority = np.concatenate((priority, p2))
-
-            for color in [COLOR.RED, COLOR.GREEN]:
-                if hits_air[COLOR.BLACK] == 0:
-                    break
-                for p in np.argsort(priority[color])[::-1]:
-                    if hits_air[COLOR.BLACK] == 0:
-                        break
-                    while air_hp[color][p] > 0 and hits_air[COLOR.BLACK] > 0:
-                        air_hp[color][p] -= 1
-                        hits_air[COLOR.BLACK] -= 1
-                        if hits_air[COLOR.BLACK] == 0:
-                            break
-
-            unit_hp = self.options['hp']['air']
-
-            for color in [COLOR.RED, COLOR.GREEN]:
-                if hits_air[COLOR.WHITE] == 0:
-                    break
-                for p in np.argsort(priority[color])[::-1]:
-                    if hits_air[COLOR.WHITE] == 0:
-                        break
-                    while air_hp[color][p] > 0 and hits_air[COLOR.WHITE] > 0 and air_hp[color][p] % unit_hp[color][p]:
-                        air_hp[color][p] -= 1
-                        hits_air[COLOR.WHITE] -= 1
-                        if hits_air[COLOR.WHITE] == 0:
-                            break
-
-        self.army[target].units_hp['air'] = air_hp
+            # black hits any plane, white only finishes off damaged ones
+            unit_hp = self.options.hp_air
+            color_idx = np.array([COLOR.RED, COLOR.RED, COLOR.GREEN, COLOR.GREEN])
+            stance_idx = np.array([1, 0, 1, 0])
+
+            air_hp[color_idx, stance_idx], _ = drain_hits(air_hp[color_idx, stance_idx], roll[COLOR.BLACK])
+            air_hp[color_idx, stance_idx], _ = drain_damaged_hits(air_hp[color_idx, stance_idx], roll[COLOR.WHITE],
+                                                                  unit_hp[color_idx, stance_idx])
+
+        if self.profiler:
+            self.profiler.count('hits', before - self.profiler.total(self.army[target].units_hp))
 
 
     def roll_ground_and_apply_hits_wr2(self, source, target, batch):
@@ -164,77 +118,49 @@ class Battle:
             return
 
         roll = self.d12_batch.roll(dice)
+        if self.profiler:
+            self.profiler.count('rolls')
+            self.profiler.count('dice', dice)
+            before = self.profiler.total(self.army[target].units_hp)
 
         # get hp pools for planes
         hits_ground = roll
-        #hits_ground = np.zeros(COLOR.BLACK)
-        #hits_ground[:COLOR.BLACK] = roll[:COLOR.BLACK]
 
         ground_hp = np.concatenate((self.army[target].units_hp['land'], 
                                     self.army[target].units_hp['sea']), axis=1)
-        unit_hp = np.concatenate((self.options['hp']['land'], 
-                                   self.options['hp']['sea'])).T
-        unit_values = np.concatenate((self.options['unit_attack']['land'][STANCE.GROUND], 
-                                      self.options['unit_attack']['sea'][STANCE.GROUND])).T
-
         # kill of units with less hp first -> more dead
-        priority = np.argsort(unit_hp)
         # we have 4 priorities for each color now
         for color in [COLOR.YELLOW, COLOR.BLUE, COLOR.GREEN, COLOR.RED]:
-            for p in priority[color][::-1]:
-                while ground_hp[color][p] > 0 and hits_ground[color] > 0:
-                    # check for escort only use to prevent sinking elsewise let the big ship soak
-                    # a bit of damage first
-                    if self.battle_ground == 'sea' and\
-                            color in [COLOR.GREEN, COLOR.RED] and\
-                            ground_hp[color][p] % self.options['hp']['sea'][0][color] == 1 and\
-                            np.any(ground_hp[COLOR.BLUE][2] > 0):
-                        ground_hp[COLOR.BLUE][2] -= 1
-                    else:
-                        # apply damage regularily
-                        ground_hp[color][p] -= 1
-
-                    hits_ground[color] -= 1
+            order = self.options.ground_hit_order[color]
+            if self.battle_ground == 'sea' and color in [COLOR.GREEN, COLOR.RED]:
+                # check for escort only use to prevent sinking elsewise let the big ship soak
+                # a bit of damage first
+                for p in order:
+                    ground_hp[color][p], ground_hp[COLOR.BLUE][2], hits_ground[color] = \
+                        drain_escorted_hits(ground_hp[color][p], hits_ground[color],
+                                            ground_hp[COLOR.BLUE][2], self.options['hp']['sea'][0][color])
+            else:
+                # apply damage regularily
+                ground_hp[color, order], hits_ground[color] = drain_hits(ground_hp[color, order], hits_ground[color])
         
 
         if self.army[target].strategy['ground'] is None:
             logging.warning("No Dice Strategy selected! - Using Highest Value first")
             self.army[target].strategy['ground'] = Strategy.BlackToHighestValueFirst
 
-        if source in self.fa:
-            if self.army[source].strategy['ground'] == Strategy.BlackToHighestValueFirst:
-                priority = self.army[target].get_ground_target_priority()
-                #BLACK
-                p = 0
-                while hits_ground[COLOR.BLACK] > 0 and p < 20:
-                    stance_idx, color_idx = np.argwhere(priority == p).squeeze()
-                    while (hits_ground[COLOR.BLACK] > 0 and \
-                            ground_hp[color_idx][stance_idx] > 0):
-                        ground_hp[color_idx][stance_idx] -= 1
-                        hits_ground[COLOR.BLACK] -= 1
-                    p += 1
-                        
-
-                #WHITE
-                p = 0
-                while hits_ground[COLOR.WHITE] > 0 and p < 20:
-                    stance_idx, color_idx = np.argwhere(priority == p).squeeze()
-                    while (hits_ground[COLOR.WHITE] > 0 and \
-                            ground_hp[color_idx][stance_idx] > 0):
-                        ground_hp[color_idx][stance_idx] -= 1
-                        hits_ground[COLOR.WHITE] -= 1
-                    p += 1
-                        
-                
-
-
-        else:
-            raise RuntimeError("No dice assignment strategy selected!")
+        if source in self.fa and self.army[source].strategy['ground'] == Strategy.BlackToHighestValueFirst:
+            # black and white go down the priority list of the target
+            color_idx, stance_idx = self.army[target].get_ground_target_order()
+            wild = hits_ground[COLOR.BLACK] + hits_ground[COLOR.WHITE]
+            ground_hp[color_idx, stance_idx], _ = drain_hits(ground_hp[color_idx, stance_idx], wild)
 
         # write back updated hp pool
         land_hp, sea_hp = np.hsplit(ground_hp, 2)
-        self.army[target].units_hp['land'] = land_hp
-        self.army[target].units_hp['sea'] = sea_hp
+        self.army[target].units_hp['land'][:] = land_hp
+        self.army[target].units_hp['sea'][:] = sea_hp
+
+        if self.profiler:
+            self.profiler.count('hits', before - self.profiler.total(self.army[target].units_hp))
 
 
 
@@ -261,8 +187,8 @@ class Battle:
             #    self.army[target].units_by_stance['sea'][0][idx] -= 1
 
             in_battle_combined = np.sum(in_battle, axis=0) # sum over different stances
-            self.army[target].units[type] = in_battle_combined
-            self.army[target].units_by_stance[type] = in_battle
+            self.army[target].units[type][:] = in_battle_combined
+            self.army[target].units_by_stance[type][:] = in_battle
 
         self.army[target].units['sea'][0] += self.army[target].submerged
         self.army[target].units_by_stance['sea'][0,0] += self.army[target].submerged
@@ -292,89 +218,53 @@ class Battle:
 
 
 
-    def roll_air_and_apply_hits_wr2qb(self, source, target):
+    def roll_air_and_apply_hits_wr2qb(self, source, target, batch):
         dice = self.options['batch_size'] if self.army[source].n_dice_air > self.options['batch_size'] else self.army[source].n_dice_air
         self.army[source].n_dice_air -= self.options['batch_size']
         self.army[source].n_dice_air = max(0, self.army[source].n_dice_air)
+        if dice == 0:
+            return
 
         roll = self.d12_batch.roll(dice)
-        # get hp pools for planes
-        hp_air_stance_0 = self.ptions['hp_air'][0]
-        hp_air_stance_1 = self.options['hp_air'][1]
-        
-        hits_air = np.zeros(5)
-        unmatched_air = np.zeros(5)
-
-        hits_air[:COLOR.BLACK] = roll[:COLOR.BLACK] // hp_air_stance_0[:COLOR.BLACK]
-        unmatched_air[:COLOR.BLACK] = roll[:COLOR.BLACK] % hp_air_stance_0[COLOR.BLACK]
-        # reset black
-        unmatched_air[COLOR.BLACK] += hits_air[COLOR.BLACK]
-        hits_air[COLOR.BLACK] = 0
-        # apply direct hits to all but black
-        self.army[target].units['air'][:COLOR.BLACK] = np.maximum(self.army[target].units['air'][:COLOR.BLACK] - hits_air[:COLOR.BLACK], [0, 0, 0, 0, 0])
-        wild = unmatched_air[COLOR.BLACK]
-        while wild > 0:
-            if wild == 0:
-                break # we matched all blacks
-            hits = unmatched_air > 0
-            trgt = self.army[target].units['land'] > 0
-            unit_targets = np.logical_and(hits[:COLOR.BLACK], trgt)
+        if self.profiler:
+            self.profiler.count('rolls')
+            self.profiler.count('dice', dice)
+            before = self.profiler.total(self.army[target].units)
 
-            # find target high to low
-            for color in range(COLOR.RED,-1,-1):
-                if unit_targets[color] and wild > 0:
-                    wild -= 1
-                    self.army[target].units['land'][color] -= 1
-                    #found one
-                    break
-            #none found
-            wild = 0
+        # quickbattle counts units - no hp pools, planes use the hp of stance 0
+        hits, unmatched, wild = split_quick_hits(roll, self.options['hp']['air'][0])
+        self.army[target].units['air'][:] = np.maximum(self.army[target].units['air'] - hits, 0)
+        # the wild dice of the air phase go to the land units
+        self.army[target].units['land'][:] = apply_wild_hit(self.army[target].units['land'], unmatched, wild)
 
+        if self.profiler:
+            self.profiler.count('hits', before - self.profiler.total(self.army[target].units))
 
 
-
-
-
-
-    def roll_land_and_apply_hits(self, source, target, batch):
-
+    def roll_ground_and_apply_hits_wr2qb(self, source, target, batch):
         dice = self.options['batch_size'] if self.army[source].n_dice_ground > self.options['batch_size'] else self.army[source].n_dice_ground
         self.army[source].n_dice_ground -= self.options['batch_size']
         self.army[source].n_dice_ground = max(0, self.army[source].n_dice_ground)
+        if dice == 0:
+            return
 
         roll = self.d12_batch.roll(dice)
+        if self.profiler:
+            self.profiler.count('rolls')
+            self.profiler.count('dice', dice)
+            before = self.profiler.total(self.army[target].units)
 
-
-        hits_land = roll // self.options['hp_land']
-        unmatched_land = roll % self.options['hp_land']
-        # reset black
-        unmatched_land[5] += hits_land[5]
-        hits_land[5] = 0
-
-        hits_land = self.apply_color_selection(source, target, hits_land)
-
-        # apply direct hits to all but black
-        self.army[target].units['land'][:5] = np.maximum(self.army[target].units['land'][:5] - hits_land[:5], [0, 0, 0, 0, 0])
+        units = self.army[target].units[self.battle_ground]
+        hits, unmatched, wild = split_quick_hits(roll, self.options['hp'][self.battle_ground][0])
+        hits = self.apply_color_selection(source, target, hits)
+        units[:] = np.maximum(units - hits, 0)
 
         if source in self.fa or not self.options['force_advantage']:
-            # apply remainder to highest valued unit
-            wild = unmatched_land[5]
-            while wild > 0:
-                if wild == 0:
-                    break # we matched all blacks
-                hits = unmatched_land > 0
-                trgt = self.army[target].units['land'] > 0
-                unit_targets = np.logical_and(hits[:5], trgt)
-
-                # find target high to low
-                for type in range(4,-1,-1):
-                    if unit_targets[type] and wild > 0:
-                        wild -= 1
-                        self.army[target].units['land'][type] -= 1
-                        #found one
-                        break
-                #none found
-                wild = 0
+            # remaining dice go to the highest valued unit
+            units[:] = apply_wild_hit(units, unmatched, wild)
+
+        if self.profiler:
+            self.profiler.count('hits', before - self.profiler.total(self.army[target].units))
 
 
     def check_batch_cap(self):
@@ -394,18 +284,33 @@ class Battle:
             logging.debug(f"Batch Cap - Limiting Army A to {self.army['A'].n_dice_ground} dice")
 
 
+    def check_batch_cap_arewethebaddies(self):
+        # every color more than the enemy costs the enemy a batch - at least one is left
+        count_a = (self.army['A'].units['land'] > 0).sum()
+        count_b = (self.army['B'].units['land'] > 0).sum()
+
+        for side, diff in [('B', count_a - count_b), ('A', count_b - count_a)]:
+            if diff > 0:
+                n_dice = self.army[side].n_dice_ground
+                self.army[side].n_dice_ground = max(n_dice - diff * self.options['batch_size'],
+                                                    min(n_dice, self.options['batch_size']))
+                logging.debug(f"Batch Cap - Limiting Army {side} to {self.army[side].n_dice_ground} dice")
+
+
     def run_warroomv2(self):
         if self.options['force_advantage']:
             self.fa = self.get_force_advantage()
         #print(f"Dice Air A: {self.army['A'].n_dice_air}")
         #print(f"Dice Air B: {self.army['B'].n_dice_air}")
 
-        for batch in range(3):
-            self.roll_air_and_apply_hits_wr2('A', 'B', batch)
-            self.roll_air_and_apply_hits_wr2('B', 'A', batch)
+        with self.profiler.phase('air'):
+            for batch in range(3):
+                self.roll_air_and_apply_hits_wr2('A', 'B', batch)
+                self.roll_air_and_apply_hits_wr2('B', 'A', batch)
 
-        self.update_unit_count('A')
-        self.update_unit_count('B')
+        with self.profiler.phase('update_unit_count'):
+            self.update_unit_count('A')
+            self.update_unit_count('B')
        
         # update land combat strenght
         self.army['A'].update_dice_ground()
@@ -421,20 +326,55 @@ class Battle:
             self.check_batch_cap()
 
         for batch in range(3):
-            self.roll_ground_and_apply_hits_wr2('A', 'B', batch)
-            self.roll_ground_and_apply_hits_wr2('B', 'A', batch)
+            with self.profiler.phase('ground'):
+                self.roll_ground_and_apply_hits_wr2('A', 'B', batch)
+                self.roll_ground_and_apply_hits_wr2('B', 'A', batch)
 
-            if self.options['recheck_force_advantage']:
-                self.fa = self.get_force_advantage()
+                if self.options['recheck_force_advantage']:
+                    self.fa = self.get_force_advantage()
 
             if self.battle_ground == 'sea':
-                self.check_submerged('A')
-                self.check_submerged('B')
+                with self.profiler.phase('check_submerged'):
+                    self.check_submerged('A')
+                    self.check_submerged('B')
 
-        self.update_unit_count('A')
-        self.update_unit_count('B')
+        with self.profiler.phase('update_unit_count'):
+            self.update_unit_count('A')
+            self.update_unit_count('B')
 
         
+    def run_quickbattle(self):
+        ''' air and ground batches on unit counts - WarRoomV2Quickbattle and AreWeTheBaddies '''
+        if self.options['force_advantage']:
+            self.fa = self.get_force_advantage()
+
+        with self.profiler.phase('air'):
+            for batch in range(3):
+                self.roll_air_and_apply_hits_wr2qb('A', 'B', batch)
+                self.roll_air_and_apply_hits_wr2qb('B', 'A', batch)
+
+        with self.profiler.phase('ground'):
+            for batch in range(3):
+                self.roll_ground_and_apply_hits_wr2qb('A', 'B', batch)
+                self.roll_ground_and_apply_hits_wr2qb('B', 'A', batch)
+
+                if self.options['recheck_force_advantage']:
+                    self.fa = self.get_force_advantage()
+
+
+    def run_warroomv2_quickbattle(self):
+        # units are counted, not pooled - the batch cap applies to the armies as deployed
+        if self.options['batch_cap']:
+            self.check_batch_cap()
+        self.run_quickbattle()
+
+
+    def run_arewethebaddies(self):
+        if self.options['batch_cap']:
+            self.check_batch_cap_arewethebaddies()
+        self.run_quickbattle()
+
+
     def _print_armies(self):
         for type in ['land', 'sea', 'air']:
             print(type)
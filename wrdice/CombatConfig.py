@@ -0,0 +1,128 @@
+from collections.abc import Mapping
+from enum import Enum
+from types import MappingProxyType
+import hashlib
+import numpy as np
+
+from wrdice.util import Strategy, STANCE
+
+
+def freeze(value):
+    ''' read only copy of an options value - dicts become mapping proxies, arrays read only '''
+    if isinstance(value, Mapping):
+        return MappingProxyType({key: freeze(v) for key, v in value.items()})
+    if isinstance(value, np.ndarray):
+        value = value.copy()
+        value.setflags(write=False)
+        return value
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    ''' plain (picklable) copy of a frozen options value '''
+    if isinstance(value, Mapping):
+        return {key: thaw(v) for key, v in value.items()}
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+
+def canonical(value):
+    ''' stable text form of an options value for hashing '''
+    if isinstance(value, Mapping):
+        return '{' + ','.join(f'{key!r}:{canonical(value[key])}' for key in sorted(value, key=str)) + '}'
+    if isinstance(value, np.ndarray):
+        return f'array({value.dtype.str},{value.shape},{value.tobytes().hex()})'
+    if isinstance(value, (list, tuple)):
+        return '[' + ','.join(canonical(v) for v in value) + ']'
+    if isinstance(value, Enum):
+        return f'{type(value).__name__}.{value.name}'
+    return repr(value)
+
+
+class CombatConfig(Mapping):
+    '''
+        immutable, precomputed form of an options dict (see config.py)
+        engines index it like the dict, the derived tables are attributes:
+            hp_ground               (color, land stances + sea stances) hp per unit
+            ground_hit_order        (color, 4) order of the ground pools a colored hit drains
+            hp_air                  (color, stance) hp per plane
+            dice_air[type]          (stance, color) air dice per unit
+            dice_ground[type]       (stance, color) ground dice per unit
+            ground_target_priority  {Strategy: priority table} - see Army.get_ground_target_priority
+            ground_target_order     {Strategy: (color_idx, stance_idx)}
+            hash                    content hash - equal options give the same hash
+    '''
+    def __init__(self, options):
+        options = freeze(options)
+        hp = options['hp']
+        hp_ground = np.concatenate((hp['land'], hp['sea'])).T
+
+        attack = options['unit_attack']
+        dice_ground = {T: attack[T][:, 1].copy() for T in ['land', 'sea', 'air']}
+        # planes only attack the ground from the ground stance
+        dice_ground['air'][STANCE.AIR] = 0
+
+        priority = {}
+        order = {}
+        if 'unit_cost_equiv' in options:
+            cost_order = {T: np.argsort(options['unit_cost_equiv'][T]) for T in ['land', 'sea']}
+            prio_land = np.stack((cost_order['land'] * 2, cost_order['land'] * 2 + 1), axis=1)
+            prio_sea = np.stack((cost_order['sea'] * 2 + 10, cost_order['sea'] * 2 + 11), axis=1)
+            prio = np.concatenate((prio_land, prio_sea), axis=1).T
+            stance_idx, color_idx = np.unravel_index(np.argsort(prio, axis=None), prio.shape)
+            priority[Strategy.BlackToHighestValueFirst] = freeze(prio)
+            order[Strategy.BlackToHighestValueFirst] = (freeze(color_idx), freeze(stance_idx))
+
+        attributes = {'options': options,
+                      'hash': hashlib.sha256(canonical(options).encode()).hexdigest(),
+                      'hp_ground': freeze(hp_ground),
+                      'ground_hit_order': freeze(np.argsort(hp_ground)[:, ::-1]),
+                      'hp_air': freeze(hp['air'].T),
+                      'dice_air': freeze({T: attack[T][:, 0] for T in ['land', 'sea', 'air']}),
+                      'dice_ground': freeze(dice_ground),
+                      'ground_target_priority': MappingProxyType(priority),
+                      'ground_target_order': MappingProxyType(order)}
+        for name, value in attributes.items():
+            object.__setattr__(self, name, value)
+
+
+    @staticmethod
+    def compile(options):
+        ''' options dict -> CombatConfig, a CombatConfig is returned as is '''
+        if isinstance(options, CombatConfig):
+            return options
+        return CombatConfig(options)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('CombatConfig is immutable')
+
+    def __getitem__(self, key):
+        return self.options[key]
+
+    def __iter__(self):
+        return iter(self.options)
+
+    def __len__(self):
+        return len(self.options)
+
+    def __hash__(self):
+        return int(self.hash[:16], 16)
+
+    def __eq__(self, other):
+        if isinstance(other, CombatConfig):
+            return self.hash == other.hash
+        return NotImplemented
+
+    def __reduce__(self):
+        return (CombatConfig, (thaw(self.options),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
@@ -1,18 +1,125 @@
 import numpy as np
+from itertools import combinations_with_replacement
+from math import factorial
 
-from wrdice.util import COLOR
+from wrdice.util import COLOR, Sampler
 
 class D12Colored:
-    def __init__(self, batchsize):
-        ''' yellow, blue, green, red, black, white'''
+    # outcome and alias tables per number of dice - shared by all instances
+    tables = {}
+
+    def __init__(self, batchsize, rng=None):
+        ''' yellow, blue, green, red, black, white
+            rng - numpy Generator or seed, a fresh generator if None
+        '''
         self.p = np.array([4/12, 3/12, 2/12, 1/12, 1/12, 1/12])
         self.P = np.cumsum(self.p)
         self.batchsize=batchsize
+        self.rng = np.random.default_rng(rng)
+        # pre-drawn uniforms for single rolls
+        self.uniforms = []
+        self.pos = 0
+
+    def get_tables(self, n_dice):
+        ''' (outcomes[k, face], p[k], alias probability[k], alias[k]) of all rolls of n_dice '''
+        if n_dice not in D12Colored.tables:
+            faces = np.array(list(combinations_with_replacement(range(len(self.p)), n_dice)), dtype=int)
+            outcomes = (faces[:, :, None] == np.arange(len(self.p))).sum(axis=1)
+            # multinomial probabilities of all rows at once
+            factorials = np.array([factorial(c) for c in range(n_dice + 1)], dtype=float)
+            p = factorial(n_dice) * np.prod(self.p ** outcomes, axis=1) / np.prod(factorials[outcomes], axis=1)
+
+            # alias table (Vose) - one uniform draw selects an outcome
+            k = len(p)
+            scaled = p * k
+            prob = np.ones(k)
+            alias = np.arange(k)
+            small = [i for i in range(k) if scaled[i] < 1.0]
+            large = [i for i in range(k) if scaled[i] >= 1.0]
+            while small and large:
+                s, l = small.pop(), large.pop()
+                prob[s] = scaled[s]
+                alias[s] = l
+                scaled[l] -= 1.0 - scaled[s]
+                (small if scaled[l] < 1.0 else large).append(l)
+
+            D12Colored.tables[n_dice] = (outcomes, p, prob, alias)
+        return D12Colored.tables[n_dice]
+
+    def outcome_table(self, n_dice):
+        ''' all rolls of n_dice with their probabilities -> (outcomes[k, face], p[k]) '''
+        return self.get_tables(n_dice)[:2]
+
+    def sample_outcomes(self, n_dice, u):
+        ''' maps uniforms u to rows of the outcome table of n_dice '''
+        outcomes, _, prob, alias = self.get_tables(n_dice)
+        u = u * len(prob)
+        idx = u.astype(int)
+        idx = np.where(u - idx < prob[idx], idx, alias[idx])
+        return outcomes[idx]
 
     def roll(self, n_dice):
         dice = np.zeros(len(self.p))
         if n_dice == 0:
             return dice
-        dice = np.random.multinomial(n_dice, pvals=self.p)
-        return dice
+        if n_dice > self.batchsize:
+            return self.rng.multinomial(n_dice, pvals=self.p)
 
+        if self.pos == len(self.uniforms):
+            self.uniforms = self.rng.random(32).tolist()
+            self.pos = 0
+        outcomes, _, prob, alias = self.get_tables(n_dice)
+        u = self.uniforms[self.pos] * len(prob)
+        self.pos += 1
+        idx = int(u)
+        if u - idx >= prob[idx]:
+            idx = alias[idx]
+        return outcomes[idx].copy()
+
+
+    def draw_faces(self, shape, sampler: Sampler = Sampler.MonteCarlo, p=None):
+        ''' faces of single dice - replayed with count_faces for common random numbers
+            Antithetic - the second half of shape[0] mirrors the uniforms of the first
+            p - face probabilities to draw from instead of the ones of the die
+        '''
+        if sampler == Sampler.Antithetic:
+            u = self.rng.random(((shape[0] + 1) // 2,) + tuple(shape[1:]))
+            u = np.concatenate((u, 1 - u))[:shape[0]]
+        else:
+            u = self.rng.random(shape)
+        P = self.P if p is None else np.cumsum(p)
+        faces = np.searchsorted(P, u, side='right')
+        return np.minimum(faces, len(self.p) - 1).astype(np.int8)
+
+    def draw_stratified_faces(self, n, n_dice):
+        ''' faces of n rolls of n_dice, one roll from each 1/n quantile of the outcome table
+            the rolls are in random order and the dice of each roll shuffled, so every
+            roll and any subset of its dice is still an unbiased sample
+        '''
+        outcomes, p = self.outcome_table(n_dice)
+        u = (np.arange(n) + self.rng.random(n)) / n
+        idx = np.minimum(np.searchsorted(np.cumsum(p), u, side='right'), len(p) - 1)
+        faces = np.repeat(np.tile(np.arange(len(self.p)), (len(outcomes), 1)), outcomes.ravel()).reshape(len(outcomes), n_dice)
+        return self.rng.permuted(faces[self.rng.permutation(idx)], axis=1).astype(np.int8)
+
+    def count_faces(self, faces, n_dice):
+        ''' roll of the first n_dice[...] of faces[..., die] -> dice[..., face] '''
+        used = np.arange(faces.shape[-1]) < np.asarray(n_dice)[..., None]
+        return (np.eye(len(self.p), dtype=int)[faces] * used[..., None]).sum(axis=-2)
+
+
+    def roll_many(self, n_dice):
+        ''' rolls one batch for each entry of n_dice at once
+            n_dice[...] -> dice[..., face]
+        '''
+        n_dice = np.asarray(n_dice, dtype=int)
+        dice = np.zeros(n_dice.shape + (len(self.p),), dtype=int)
+        for n in np.unique(n_dice):
+            if n == 0:
+                continue
+            mask = n_dice == n
+            if n > self.batchsize:
+                dice[mask] = self.rng.multinomial(n, pvals=self.p, size=mask.sum())
+            else:
+                dice[mask] = self.sample_outcomes(n, self.rng.random(mask.sum()))
+        return dice
@@ -0,0 +1,338 @@
+from wrdice.Army import Army
+from wrdice.BatchBattle import BatchBattle
+from wrdice.util import *
+
+from math import comb
+import numpy as np
+
+
+class ExactBattle(BatchBattle):
+    '''
+        Exact outcome distribution of a WarRoomV2 battle.
+        run returns the status of each distinct outcome, its probability is in p
+
+        Instead of sampling, a roll expands every state of the target into all
+        possible outcomes of the batch weighted by their probability. Identical
+        states are merged after every batch, so p[side] holds the probability of
+        each distinct state of that side.
+        Ground hits are applied color by color and black/white last, so a ground
+        roll is expanded one face at a time (conditional binomials over the dice
+        left) with a merge after each face instead of all multinomial outcomes.
+
+        Both sides are tracked separately: the air phase of one side only depends
+        on the (fixed) air dice of the other one, and once the ground dice of both
+        sides are known the ground phases are independent as well. The solver
+        therefore branches on the ground dice after the air phase and combines
+        the two sides of each branch at the end.
+        The phases themselves are the ones of BatchBattle.
+    '''
+    def __init__(self, army_a: Army, army_b: Army, options, max_states: int = 200_000, chunk_size: int = 250_000):
+        super().__init__(army_a, army_b, options, 1)
+        self.p = {'A': np.ones(1),
+                  'B': np.ones(1)}
+        self.max_states = max_states
+        self.chunk_size = chunk_size
+        self.target = None
+        # dice of the current ground roll not assigned to a face yet
+        self.rem = {'A': np.zeros(1, dtype=int),
+                    'B': np.zeros(1, dtype=int)}
+        # air - faces that are hit-equivalent, ground - (face, conditional probability)
+        self.groups = None
+        self.stage = None
+        self.tables = {}
+
+
+    def outcome_table(self, n_dice):
+        '''
+            all rolls of n_dice with their probabilities
+            faces in the same group are only counted together - the count is put on
+            the first face of the group
+        '''
+        key = (n_dice, self.groups)
+        if key not in self.tables:
+            outcomes, p = self.d12_batch.outcome_table(n_dice)
+            grouped = np.zeros_like(outcomes)
+            for group in self.groups:
+                grouped[:, group[0]] = outcomes[:, list(group)].sum(axis=1)
+            grouped, inverse = np.unique(grouped, axis=0, return_inverse=True)
+            self.tables[key] = (grouped, np.bincount(inverse.ravel(), weights=p))
+        return self.tables[key]
+
+
+    def binomial_table(self, p):
+        ''' pmf[n, k] of k successes out of n <= batch_size '''
+        key = ('binomial', p)
+        if key not in self.tables:
+            n = np.arange(self.options['batch_size'] + 1)
+            pmf = np.zeros((len(n), len(n)))
+            for i in n:
+                for k in range(i + 1):
+                    pmf[i, k] = comb(i, k) * p ** k * (1 - p) ** (i - k)
+            self.tables[key] = pmf
+        return self.tables[key]
+
+
+    def get_num_colors_land(self, side):
+        # land units are only counted again after the ground phase - same for all states
+        return (self.units[side]['land'][:1] > 0).sum(axis=1)
+
+
+    def get_state(self, side, idx=slice(None)):
+        return {'units': {T: v[idx] for T, v in self.units[side].items()},
+                'units_by_stance': {T: v[idx] for T, v in self.units_by_stance[side].items()},
+                'units_hp': {T: v[idx] for T, v in self.units_hp[side].items()},
+                'submerged': self.submerged[side][idx],
+                'rem': self.rem[side][idx],
+                'p': self.p[side][idx]}
+
+
+    def set_state(self, side, state):
+        self.units[side] = dict(state['units'])
+        self.units_by_stance[side] = dict(state['units_by_stance'])
+        self.units_hp[side] = dict(state['units_hp'])
+        self.submerged[side] = state['submerged']
+        self.rem[side] = state['rem']
+        self.p[side] = state['p']
+
+
+    def take(self, side, idx):
+        self.set_state(side, self.get_state(side, idx))
+
+
+    @staticmethod
+    def concat_states(states):
+        return {'units': {T: np.concatenate([s['units'][T] for s in states]) for T in states[0]['units']},
+                'units_by_stance': {T: np.concatenate([s['units_by_stance'][T] for s in states]) for T in states[0]['units_by_stance']},
+                'units_hp': {T: np.concatenate([s['units_hp'][T] for s in states]) for T in states[0]['units_hp']},
+                'submerged': np.concatenate([s['submerged'] for s in states]),
+                'rem': np.concatenate([s['rem'] for s in states]),
+                'p': np.concatenate([s['p'] for s in states])}
+
+
+    def merge_states(self, side):
+        ''' merge identical states of one side and sum up their probability '''
+        n = len(self.p[side])
+        key = [self.submerged[side][:, None], self.rem[side][:, None], self.units[side]['land']]
+        key += [hp.reshape(n, -1) for hp in self.units_hp[side].values()]
+        key = np.ascontiguousarray(np.concatenate(key, axis=1).astype(np.int16))
+
+        _, first, inverse = np.unique(key.view(np.dtype((np.void, key.shape[1] * key.itemsize))).ravel(),
+                                      return_index=True, return_inverse=True)
+        p = np.bincount(inverse.ravel(), weights=self.p[side])
+        self.take(side, first)
+        self.p[side] = p
+
+        if len(p) > self.max_states:
+            raise RuntimeError(f"Exact solver exceeds {self.max_states} states - use a sampling backend")
+
+
+    def roll_dice(self, n_dice, slot=None):
+        ''' expands the states of the current target by all outcomes of the roll '''
+        n = len(self.p[self.target])
+        if self.stage is None:
+            roll, p = self.outcome_table(int(np.max(n_dice)))
+            self.take(self.target, np.repeat(np.arange(n), len(p)))
+            self.p[self.target] = self.p[self.target] * np.tile(p, n)
+            return np.tile(roll, (n, 1))
+
+        # one face - k hits out of the dice left
+        face, p = self.stage
+        rem = self.rem[self.target]
+        idx = np.repeat(np.arange(n), rem + 1)
+        k = np.arange(len(idx)) - np.repeat(np.cumsum(rem + 1) - (rem + 1), rem + 1)
+        self.take(self.target, idx)
+        self.p[self.target] = self.p[self.target] * self.binomial_table(p)[rem[idx], k]
+        self.rem[self.target] = rem[idx] - k
+
+        roll = np.zeros((len(idx), len(self.d12_batch.p)), dtype=int)
+        roll[:, face] = k
+        return roll
+
+
+    def expand(self, apply, source, target, batch, n_outcomes):
+        '''
+            applies one roll of source on all states of target
+            the states are processed in chunks to bound the size of the expansion
+        '''
+        self.target = target
+        n_dice_air = self.n_dice_air[source]
+        n_dice_ground = self.n_dice_ground[source]
+
+        state = self.get_state(target)
+        step = max(1, self.chunk_size // n_outcomes)
+        parts = []
+        for start in range(0, len(state['p']), step):
+            self.n_dice_air[source] = n_dice_air
+            self.n_dice_ground[source] = n_dice_ground
+            self.set_state(target, state)
+            self.take(target, slice(start, start + step))
+            apply(source, target, batch)
+            self.merge_states(target)
+            parts.append(self.get_state(target))
+
+        self.set_state(target, self.concat_states(parts))
+        self.merge_states(target)
+
+
+    def roll_air_and_apply_hits_wr2(self, source, target, batch):
+        if self.army[source].strategy['air'] == Strategy.BlackToHighestValueFirst:
+            self.groups = ((COLOR.GREEN,), (COLOR.RED,), (COLOR.BLACK,), (COLOR.WHITE,), (COLOR.YELLOW, COLOR.BLUE))
+        else:
+            self.groups = ((COLOR.GREEN,), (COLOR.RED,), (COLOR.YELLOW, COLOR.BLUE, COLOR.BLACK, COLOR.WHITE))
+        self.stage = None
+        n_outcomes = len(self.outcome_table(self.options['batch_size'])[1])
+        self.expand(super().roll_air_and_apply_hits_wr2, source, target, batch, n_outcomes)
+
+
+    def roll_ground_and_apply_hits_wr2(self, source, target, batch):
+        dice = min(self.options['batch_size'], self.n_dice_ground[source][0])
+        n_dice_ground = self.n_dice_ground[source]
+
+        # faces that can change the state of the target - black and white always go together
+        hp = np.concatenate((self.units_hp[target]['land'], self.units_hp[target]['sea']), axis=2)
+        has_hp = hp.any(axis=(0, 2))
+        p = self.d12_batch.p
+        stages = [(color, p[color]) for color in [COLOR.YELLOW, COLOR.BLUE, COLOR.GREEN, COLOR.RED] if has_hp[color]]
+        if np.any(self.fa[source] & self.strategy_set[source]) and has_hp.any():
+            stages.append((COLOR.BLACK, p[COLOR.BLACK] + p[COLOR.WHITE]))
+        if dice == 0 or len(stages) == 0:
+            # nothing to hit - only the dice and strategy bookkeeping of the roll
+            stages = [(COLOR.YELLOW, 0.0)]
+
+        self.rem[target] = np.full(len(self.p[target]), dice)
+        mass = 1.0
+        for face, q in stages:
+            self.n_dice_ground[source] = n_dice_ground
+            self.stage = (face, min(1.0, q / mass))
+            mass -= q
+            self.expand(super().roll_ground_and_apply_hits_wr2, source, target, batch, dice + 1)
+        self.rem[target] = np.zeros(len(self.p[target]), dtype=int)
+        self.stage = None
+
+
+    def get_outcomes(self, side, air):
+        '''
+            distinct final survivors of one side
+            air holds the air units and probability of the states after the air phase,
+            they are combined with the states after the ground phase
+            -> (units[type], submerged, p)
+        '''
+        def distinct(key, p):
+            key = np.ascontiguousarray(key.astype(np.int16))
+            _, first, inverse = np.unique(key.view(np.dtype((np.void, key.shape[1] * key.itemsize))).ravel(),
+                                          return_index=True, return_inverse=True)
+            return first, np.bincount(inverse.ravel(), weights=p)
+
+        ground = np.concatenate([self.units[side]['land'], self.units[side]['sea'], self.submerged[side][:, None]], axis=1)
+        first_g, p_g = distinct(ground, self.p[side])
+        first_a, p_a = distinct(air[0], air[1])
+
+        idx_g, idx_a = [idx.ravel() for idx in np.meshgrid(first_g, first_a, indexing='ij')]
+        units = {'land': self.units[side]['land'][idx_g],
+                 'sea': self.units[side]['sea'][idx_g],
+                 'air': air[0][idx_a]}
+        return units, self.submerged[side][idx_g], np.outer(p_g, p_a).ravel()
+
+
+    def run_ground_warroomv2(self, target):
+        '''
+            ground phase of run_warroomv2 for the hits taken by target only
+            the rolls against the other side are reduced to their bookkeeping
+        '''
+        for batch in range(3):
+            for source, side in [('A', 'B'), ('B', 'A')]:
+                if side == target:
+                    self.roll_ground_and_apply_hits_wr2(source, side, batch)
+                    continue
+                active = min(self.options['batch_size'], self.n_dice_ground[source][0]) > 0
+                self.n_dice_ground[source] = np.maximum(0, self.n_dice_ground[source] - self.options['batch_size'])
+                if active and self.army[side].strategy['ground'] is None:
+                    self.strategy_set[side] |= True
+
+            if self.options['recheck_force_advantage']:
+                self.fa = self.get_force_advantage()
+
+            if self.battle_ground == 'sea':
+                self.check_submerged(target)
+
+        self.update_unit_count(target)
+
+
+    def run_quickbattle(self):
+        raise NotImplementedError("the exact solver only supports WarRoomV2")
+
+
+    def run_warroomv2(self):
+        if self.options['force_advantage']:
+            self.fa = self.get_force_advantage()
+
+        for batch in range(3):
+            self.roll_air_and_apply_hits_wr2('A', 'B', batch)
+            self.roll_air_and_apply_hits_wr2('B', 'A', batch)
+
+        self.update_unit_count('A')
+        self.update_unit_count('B')
+
+        # update land combat strenght
+        self.update_dice_ground('A')
+        self.update_dice_ground('B')
+
+        if self.options['batch_cap']:
+            self.check_batch_cap()
+
+        # the ground phase does not touch air units - it only depends on the air phase
+        # through the ground dice, so branch on those and start each branch from a
+        # single state per side
+        # dice beyond the three batches are never rolled
+        post_air = {side: (self.get_state(side), np.minimum(self.n_dice_ground[side], 3 * self.options['batch_size']))
+                    for side in ['A', 'B']}
+        fa = self.fa
+        strategy_set = self.strategy_set
+
+        # the damage taken by one side only depends on the dice of the other side and
+        # on whether it rolled any dice itself (strategy fallback) - shared by branches
+        ground = {}
+        branches = []
+        for n_a in np.unique(post_air['A'][1]):
+            for n_b in np.unique(post_air['B'][1]):
+                outcomes = []
+                for target, n_target, n_source in [('A', n_a, n_b), ('B', n_b, n_a)]:
+                    key = (target, n_source, n_target > 0)
+                    if key not in ground:
+                        for side, n in [('A', n_a), ('B', n_b)]:
+                            self.set_state(side, post_air[side][0])
+                            self.take(side, np.flatnonzero(post_air[side][1] == n)[:1])
+                            self.p[side] = np.ones(1)
+                            self.n_dice_ground[side] = np.array([n])
+                        self.fa = dict(fa)
+                        self.strategy_set = {side: v.copy() for side, v in strategy_set.items()}
+                        self.run_ground_warroomv2(target)
+                        ground[key] = self.get_state(target)
+
+                    state, n_dice = post_air[target]
+                    rows = np.flatnonzero(n_dice == n_target)
+                    self.set_state(target, ground[key])
+                    outcomes.append(self.get_outcomes(target, (state['units']['air'][rows], state['p'][rows])))
+                branches.append(outcomes)
+
+        n_outcomes = sum(len(p_a) * len(p_b) for (_, _, p_a), (_, _, p_b) in branches)
+        if n_outcomes > self.max_states:
+            raise RuntimeError(f"Exact solver exceeds {self.max_states} outcomes - use a sampling backend")
+
+        # both sides are independent within a branch - combine them
+        p = []
+        units = {side: {T: [] for T in ['land', 'air', 'sea']} for side in ['A', 'B']}
+        submerged = {'A': [], 'B': []}
+        for (units_a, sub_a, p_a), (units_b, sub_b, p_b) in branches:
+            idx_a, idx_b = [idx.ravel() for idx in np.meshgrid(np.arange(len(p_a)), np.arange(len(p_b)), indexing='ij')]
+            p.append(p_a[idx_a] * p_b[idx_b])
+            for T in ['land', 'air', 'sea']:
+                units['A'][T].append(units_a[T][idx_a])
+                units['B'][T].append(units_b[T][idx_b])
+            submerged['A'].append(sub_a[idx_a])
+            submerged['B'].append(sub_b[idx_b])
+
+        self.units = {side: {T: np.concatenate(v) for T, v in units[side].items()} for side in units}
+        self.submerged = {side: np.concatenate(v) for side, v in submerged.items()}
+        self.p = np.concatenate(p)
+        self.n = len(self.p)
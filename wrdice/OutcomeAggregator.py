@@ -0,0 +1,97 @@
+from collections import Counter
+import numpy as np
+
+
+# colors of each unit type in a packed survivor vector
+UNIT_SLICES = {'land': slice(0, 5),
+               'sea': slice(5, 10),
+               'air': slice(10, 15)}
+
+
+class OutcomeAggregator:
+    '''
+        running summary of the trials of a simulation, updated as trials finish
+            counts              (outcome,) weight of each returncode
+            sums[side]          (outcome, unit) weighted survivor sums
+            hist[side]          (unit, count) weight of each survivor count per unit
+            variations[side]    Counter packed returncode + survivors -> weight
+        a survivor vector packs the land, sea and air colors into 15 int8
+        reports only read these tables, so they cost O(distinct outcomes)
+    '''
+    def __init__(self):
+        self.counts = np.zeros(4)
+        self.sums = {side: np.zeros((4, 15)) for side in ['A', 'B']}
+        self.hist = {side: np.zeros((15, 128)) for side in ['A', 'B']}
+        self.variations = {side: Counter() for side in ['A', 'B']}
+
+
+    def add(self, status: int, armies) -> None:
+        ''' one trial - armies are the armies of the finished battle by side '''
+        self.counts[status] += 1
+        for side, army in armies.items():
+            units = np.concatenate((army.units['land'], army.units['sea'], army.units['air'])).astype(np.int8)
+            units[UNIT_SLICES['sea'].start] += army.submerged
+            self.sums[side][status] += units
+            self.hist[side][np.arange(15), units] += 1
+            self.variations[side][bytes([status]) + units.tobytes()] += 1
+
+
+    def extend(self, status: np.ndarray, survivors, weights=None) -> None:
+        ''' block of trials - survivors[side][type] (n, color), weights per trial (default 1) '''
+        status = np.asarray(status)
+        weights = np.ones(len(status)) if weights is None else np.asarray(weights, dtype=float)
+        self.counts += np.bincount(status, weights=weights, minlength=4)
+        by_outcome = np.eye(4)[status] * weights[:, None]
+
+        for side, s in survivors.items():
+            units = np.concatenate([s[T] for T in UNIT_SLICES], axis=1).astype(np.int8)
+            self.sums[side] += by_outcome.T @ units
+            for i in range(15):
+                self.hist[side][i] += np.bincount(units[:, i], weights=weights, minlength=128)
+
+            # one opaque 16 byte value per trial - much faster to unique than rows
+            packed = np.concatenate((status[:, None].astype(np.int8), units), axis=1)
+            keys, inverse = np.unique(packed.view(np.dtype((np.void, 16))).ravel(), return_inverse=True)
+            key_weights = np.bincount(inverse, weights=weights, minlength=len(keys))
+            counter = self.variations[side]
+            for key, weight in zip(keys, key_weights):
+                counter[key.tobytes()] += weight
+
+
+    def average(self, side: str, outcome: int, type: str) -> np.ndarray:
+        ''' mean survivors (type colors, air colors) of the trials with this outcome '''
+        if self.counts[outcome] == 0:
+            return np.zeros(10)
+        sums = self.sums[side][outcome]
+        return np.concatenate((sums[UNIT_SLICES[type]], sums[UNIT_SLICES['air']])) / self.counts[outcome]
+
+
+    def top_variations(self, side: str, outcome: int, type: str, N: int = 10):
+        '''
+            most frequent survivors (type colors, air colors) of the trials with
+            this outcome and their share of these trials
+        '''
+        rows, weights = [], []
+        for key, weight in self.variations[side].items():
+            if key[0] == outcome:
+                units = np.frombuffer(key, dtype=np.int8)[1:]
+                rows.append(np.concatenate((units[UNIT_SLICES[type]], units[UNIT_SLICES['air']])))
+                weights.append(weight)
+        if len(rows) == 0:
+            return np.zeros((0, 10), dtype=int), np.zeros(0)
+
+        # vectors that only differ in the other ground type are merged
+        variations, inverse = np.unique(np.array(rows), axis=0, return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=weights, minlength=len(variations))
+        sorting = np.argsort(counts)[::-1][:N]
+        return variations[sorting].astype(int), counts[sorting] / counts.sum()
+
+
+    def unit_hist(self, side: str, type: str):
+        ''' [(survivor counts, share of all trials)] for each color of type '''
+        total = self.counts.sum()
+        stats = []
+        for hist in self.hist[side][UNIT_SLICES[type]]:
+            num = np.flatnonzero(hist)
+            stats.append((num, hist[num] / total))
+        return stats
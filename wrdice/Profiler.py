@@ -0,0 +1,151 @@
+import time
+import tracemalloc
+
+
+class Profiler:
+    '''
+        optional instrumentation of a simulation
+            phases[name]    [seconds, calls, allocated bytes] - nested phases are named
+                            'outer/inner', e.g. 'battle/air'
+            counters[name]  dice rolled, hits applied, rolls, trials, chunks ...
+        engines wrap their phases in `with profiler.phase(name)` and only count
+        behind `if profiler:` - the disabled profiler NO_PROFILER is falsy and its
+        phase is a shared no-op, so uninstrumented runs pay next to nothing
+        trace_memory adds the peak bytes allocated above the start of every top level
+        phase (tracemalloc, slow)
+        hooks are called with report() on emit - after every run and every chunk of
+        an adaptive run, e.g. to push the numbers to a metrics exporter
+    '''
+    def __init__(self, trace_memory: bool = False, hooks=()):
+        self.trace_memory = trace_memory
+        self.hooks = list(hooks)
+        self.phases = {}
+        self.counters = {}
+        self.stack = []
+
+
+    def __bool__(self):
+        return True
+
+
+    def phase(self, name: str):
+        return _Phase(self, name)
+
+
+    def count(self, name: str, n=1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+
+    @staticmethod
+    def total(pools) -> int:
+        ''' sum over a dict of unit or hp arrays - hits applied are the drop of it '''
+        return sum(int(pool.sum()) for pool in pools.values())
+
+
+    def add_hook(self, hook) -> None:
+        self.hooks.append(hook)
+
+
+    def emit(self) -> None:
+        if self.hooks:
+            report = self.report()
+            for hook in self.hooks:
+                hook(report)
+
+
+    def clear(self) -> None:
+        self.phases = {}
+        self.counters = {}
+
+
+    def report(self) -> dict:
+        '''
+            {'trials': n,
+             'phases': {name: {'s', 'calls', 'share', 'per_trial_us'[, 'alloc_per_trial']}},
+             'counters': {name: {'total', 'per_trial'}}}
+            share is the fraction of the parent phase (of all top level phases at the top)
+        '''
+        trials = max(self.counters.get('trials', 0), 1)
+        top = sum(s for name, (s, _, _) in self.phases.items() if '/' not in name)
+        phases = {}
+        for name, (s, calls, alloc) in self.phases.items():
+            parent = name.rpartition('/')[0]
+            whole = self.phases[parent][0] if parent in self.phases else top
+            phases[name] = {'s': s, 'calls': calls,
+                            'share': s / whole if whole else 0.0,
+                            'per_trial_us': s / trials * 1e6}
+            if self.trace_memory and '/' not in name:
+                phases[name]['alloc_per_trial'] = alloc / trials
+        counters = {name: {'total': n, 'per_trial': n / trials} for name, n in self.counters.items()}
+        return {'trials': self.counters.get('trials', 0), 'phases': phases, 'counters': counters}
+
+
+    def format_report(self) -> str:
+        report = self.report()
+        lines = [f"profile of {report['trials']} trials"]
+        for name, p in report['phases'].items():
+            line = f"{'  ' * name.count('/')}{name.rpartition('/')[2]:<{24 - 2 * name.count('/')}} " \
+                   f"{p['s'] * 1000:10.2f} ms {p['share']:7.1%} {p['per_trial_us']:10.2f} us/trial"
+            if 'alloc_per_trial' in p:
+                line += f" {p['alloc_per_trial'] / 1024:10.2f} KiB/trial"
+            lines.append(line)
+        for name, c in report['counters'].items():
+            lines.append(f"{name:<24} {c['total']:13d}    {c['per_trial']:10.2f} /trial")
+        return '\n'.join(lines)
+
+
+class _Phase:
+    ''' context of one timed phase '''
+    __slots__ = ('profiler', 'name', 'entry', 'start', 'alloc')
+
+    def __init__(self, profiler: Profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        profiler = self.profiler
+        profiler.stack.append(self.name)
+        # registered on entry so that a phase is listed before the ones nested in it
+        self.entry = profiler.phases.setdefault('/'.join(profiler.stack), [0.0, 0, 0])
+        self.alloc = None
+        if profiler.trace_memory and len(profiler.stack) == 1 and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            self.alloc = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.profiler.stack.pop()
+        entry = self.entry
+        entry[0] += elapsed
+        entry[1] += 1
+        if self.alloc is not None:
+            entry[2] += tracemalloc.get_traced_memory()[1] - self.alloc
+        return False
+
+
+class _NoProfiler:
+    ''' stands in for a disabled Profiler '''
+    __slots__ = ()
+
+    def __bool__(self):
+        return False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def phase(self, name: str):
+        return self
+
+    def count(self, name: str, n=1) -> None:
+        pass
+
+    def emit(self) -> None:
+        pass
+
+
+NO_PROFILER = _NoProfiler()
@@ -1,14 +1,13 @@
-import math
+import os
+import sys
+
 import numpy as np
-import copy
-import pdb
-from tqdm import tqdm
-from enum import Enum, auto
 
-class ColorSelectionStrategy(Enum):
-    MAX_NUM_HITS_FIRST = auto()
-    MAX_MORALE_LOST_FIRST = auto()
-    MAX_COLOR_REDUCTION_FIRST = auto() 
+if __package__ in (None, ''):
+    # run as a plain script - make the package importable
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wrdice.util import ColorSelectionStrategy, split_quick_hits, apply_wild_hit, color_selection_mask
 
 
 '''
@@ -44,33 +43,21 @@ options = {
 }
 
 class d12colored:
-    def __init__(self, batchsize):
+    def __init__(self, batchsize, rng=None):
         ''' yellow, blue, green, red, white, black'''
         self.p = np.array([4/12, 3/12, 2/12, 1/12, 1/12, 1/12])
         self.P = np.cumsum(self.p)
         self.batchsize=batchsize
+        self.rng = np.random.default_rng(rng)
 
-    def __r(self, r):
-        if r >= self.P[4]:
-            return 5
-        elif r >= self.P[3]:
-            return 4
-        elif r >= self.P[2]:
-            return 3
-        elif r >= self.P[1]:
-            return 2
-        elif r >= self.P[0]:
-            return 1
-        else:
-            return 0
- 
     def roll(self, n_dice):
-        res = np.random.random_sample(n_dice)
-        roll = [self.__r(r) for r in res]
-        # sort rolls into bins
-        bins = bins=np.arange(-0.5, len(self.p)+.5, 1)
-        binned = np.histogram(roll, bins)[0]
-        return binned
+        ''' one roll for each entry of n_dice - n_dice[...] -> binned[..., face] '''
+        n_dice = np.asarray(n_dice)
+        u = self.rng.random(n_dice.shape + (int(n_dice.max(initial=0)),))
+        # face of every die with a single search over the cumulative probabilities
+        faces = np.minimum(np.searchsorted(self.P, u, side='right'), len(self.p) - 1)
+        used = np.arange(u.shape[-1]) < n_dice[..., None]
+        return (np.eye(len(self.p), dtype=int)[faces] * used[..., None]).sum(axis=-2)
 
 
 
@@ -98,82 +85,53 @@ class Army:
 
 
 class Battle:
-    def __init__(self, army_a: Army, army_b: Army):
+    '''
+        n battles of the same armies at once - units_land[side] and units_air[side]
+        are (n, color) arrays, every batch is rolled for all of them with one call
+    '''
+    def __init__(self, army_a: Army, army_b: Army, n: int = 1, rng=None):
         self.army = {'A' : army_a, 
                      'B' : army_b}
+        self.n = n
 
-        self.d12_batch = d12colored(options['batch_size'])
+        self.d12_batch = d12colored(options['batch_size'], rng)
 
-        self.fa = ['A', 'B'] #both side have black and white
+        self.units_land = {side: np.repeat(np.asarray(army.units_land)[None, :], n, axis=0) for side, army in self.army.items()}
+        self.units_air = {side: np.repeat(np.asarray(army.units_air)[None, :], n, axis=0) for side, army in self.army.items()}
+        self.n_dice_ground = {side: np.full(n, army.n_dice_ground) for side, army in self.army.items()}
+        self.n_dice_air = {side: int(army.n_dice_air) for side, army in self.army.items()}
+
+        #both side have black and white
+        self.fa = {side: np.ones(n, dtype=bool) for side in self.army}
 
     def get_num_colors_land(self, side):
-        unique = np.unique(np.argwhere(self.army[side].units_land))
-        return len(unique)
+        return (self.units_land[side] > 0).sum(axis=1)
 
 
     def get_force_advantage(self):
         num_colors_a = self.get_num_colors_land('A')
         num_colors_b = self.get_num_colors_land('B')
-        if num_colors_a > num_colors_b:
-            return ['A']
-        elif num_colors_b > num_colors_a:
-            return ['B']
-        else:
-            return ['A', 'B']
-
-
-    def check_force_advantage(self, side):
-        fa = self.get_force_advantage()
-        if fa is None or side in fa:
-            return True
-        else:
-            return False
+        return {'A': num_colors_a >= num_colors_b,
+                'B': num_colors_b >= num_colors_a}
 
 
     def expected_hits(self, source, target):
-        P = self.d12_batch.p[:5]
-
-        if source in self.fa:
-            P = P + self.d12_batch.p[5]
+        P = self.d12_batch.p[:5] + np.where(self.fa[source], self.d12_batch.p[5], 0)[:, None]
 
         mu = (P * options['batch_size']) // options['hp_land']
-        exp = np.minimum(self.army[target].units_land, mu)
+        exp = np.minimum(self.units_land[target], mu)
         return exp
 
     def roll_air_and_apply_hits(self, source, target):
-        dice = options['batch_size'] if self.army[source].n_dice_air > options['batch_size'] else self.army[source].n_dice_air
-        self.army[source].n_dice_air -= options['batch_size']
-        self.army[source].n_dice_air = max(0, self.army[source].n_dice_air)
+        dice = min(options['batch_size'], self.n_dice_air[source])
+        self.n_dice_air[source] = max(0, self.n_dice_air[source] - options['batch_size'])
 
-        roll = self.d12_batch.roll(dice)
+        roll = self.d12_batch.roll(np.full(self.n, dice))
 
-        hits_air = roll // options['hp_air']
-        unmatched_air = roll % options['hp_air']
-        # reset black
-        unmatched_air[5] += hits_air[5]
-        hits_air[5] = 0
+        hits_air, unmatched_air, wild = split_quick_hits(roll, np.full(5, options['hp_air']))
         # apply direct hits to all but black
-        self.army[target].units_air[:5] = np.maximum(self.army[target].units_air[:5] - hits_air[:5], [0, 0, 0, 0, 0])
-        wild = unmatched_air[5]
-        while wild > 0:
-            if wild == 0:
-                break # we matched all blacks
-            hits = unmatched_air > 0
-            trgt = self.army[target].units_land > 0
-            unit_targets = np.logical_and(hits[:5], trgt)
-
-            # find target high to low
-            for type in range(4,-1,-1):
-                if unit_targets[type] and wild > 0:
-                    wild -= 1
-                    self.army[target].units_land[type] -= 1
-                    #found one
-                    break
-            #none found
-            wild = 0
-
-
-
+        self.units_air[target] = np.maximum(self.units_air[target] - hits_air, 0)
+        self.units_land[target] = apply_wild_hit(self.units_land[target], unmatched_air, wild)
 
 
     def apply_color_selection(self, source, target, hits):
@@ -182,93 +140,42 @@ class Battle:
             return hits
 
         # we can only select as much enemy colors as target as we bring into the fight
-        num_colors = self.get_num_colors_land(source)
-        if options['color_select_strategy'] == ColorSelectionStrategy.MAX_NUM_HITS_FIRST:
-            exp = self.expected_hits(source, target)
-            # select the num_colors colors with the most units to hit realisticly 
-            # as we later use the indexes to clear the hits we are interested in the rest
-            color_select_to_delete = np.argsort(exp)[::-1][-num_colors:]
-
-        elif options['color_select_strategy'] == ColorSelectionStrategy.MAX_MORALE_LOST_FIRST:
-            exp = self.expected_hits(source, target)
-            exp *= options['unit_morale_land']
-            color_select_to_delete = np.argsort(exp)[::-1][:num_colors]
-
-        elif options['color_select_strategy'] == ColorSelectionStrategy.MAX_COLOR_REDUCTION_FIRST:
-            exp = self.expected_hits(source, target)
-            exp_after = self.army[target].units_land - exp
-            color_select = np.argwhere(np.logical_and(exp_after<=0, self.army[target].units_land>0))
-            color_select_to_delete = np.delete(np.arange(5), color_select)
-            if len(color_select) == 0:
-                # we cannot reduce one color directly... fallback to MAX_MORALE
-                exp = self.expected_hits(source, target)
-                exp *= options['unit_morale_land']
-                color_select_to_delete = np.argsort(exp)[::-1][:num_colors]
-
-
-        #apply color selection to hits_land
-        hits[color_select_to_delete] = 0
-        return hits
+        drop = color_selection_mask(options['color_select_strategy'], self.expected_hits(source, target),
+                                    self.units_land[target], self.get_num_colors_land(source),
+                                    np.asarray(options['unit_morale_land']))
+        return np.where(drop, 0, hits)
 
 
 
     def roll_land_and_apply_hits(self, source, target):
 
-        dice = options['batch_size'] if self.army[source].n_dice_ground > options['batch_size'] else self.army[source].n_dice_ground
-        self.army[source].n_dice_ground -= options['batch_size']
-        self.army[source].n_dice_ground = max(0, self.army[source].n_dice_ground)
+        dice = np.minimum(options['batch_size'], self.n_dice_ground[source])
+        self.n_dice_ground[source] = np.maximum(0, self.n_dice_ground[source] - options['batch_size'])
 
         roll = self.d12_batch.roll(dice)
 
-
-        hits_land = roll // options['hp_land']
-        unmatched_land = roll % options['hp_land']
-        # reset black
-        unmatched_land[5] += hits_land[5]
-        hits_land[5] = 0
-
+        hits_land, unmatched_land, wild = split_quick_hits(roll, np.full(5, options['hp_land']))
         hits_land = self.apply_color_selection(source, target, hits_land)
 
         # apply direct hits to all but black
-        self.army[target].units_land[:5] = np.maximum(self.army[target].units_land[:5] - hits_land[:5], [0, 0, 0, 0, 0])
+        self.units_land[target] = np.maximum(self.units_land[target] - hits_land, 0)
 
-        if source in self.fa or not options['force_advantage']:
+        if not options['force_advantage']:
+            self.units_land[target] = apply_wild_hit(self.units_land[target], unmatched_land, wild)
+        else:
             # apply remainder to highest valued unit
-            wild = unmatched_land[5]
-            while wild > 0:
-                if wild == 0:
-                    break # we matched all blacks
-                hits = unmatched_land > 0
-                trgt = self.army[target].units_land > 0
-                unit_targets = np.logical_and(hits[:5], trgt)
-
-                # find target high to low
-                for type in range(4,-1,-1):
-                    if unit_targets[type] and wild > 0:
-                        wild -= 1
-                        self.army[target].units_land[type] -= 1
-                        #found one
-                        break
-                #none found
-                wild = 0
+            self.units_land[target] = apply_wild_hit(self.units_land[target], unmatched_land,
+                                                     np.where(self.fa[source], wild, 0))
 
 
     def check_batch_cap(self):
         # count colors (warroom 2.0 rules)
-        count_a = np.argwhere(self.army['A'].units_land).sum()
-        count_b = np.argwhere(self.army['B'].units_land).sum()
-        if count_a > count_b:
-            diff = count_a - count_b
-            dice_diff = diff * options['batch_size']
-            self.army['B'].n_dice_ground -= dice_diff
+        count_a = self.get_num_colors_land('A')
+        count_b = self.get_num_colors_land('B')
+        for side, diff in [('B', count_a - count_b), ('A', count_b - count_a)]:
+            capped = np.maximum(self.n_dice_ground[side] - diff * options['batch_size'], options['batch_size'])
             #give em at least one batch
-            self.army['B'].n_dice_ground = max(self.army['B'].n_dice_ground, options['batch_size'])
-        elif count_b > count_a:
-            diff = count_b - count_a
-            dice_diff = diff * options['batch_size']
-            self.army['A'].n_dice_ground -= dice_diff
-            #give em at least one batch
-            self.army['A'].n_dice_ground = max(self.army['A'].n_dice_ground, options['batch_size'])
+            self.n_dice_ground[side] = np.where(diff > 0, capped, self.n_dice_ground[side])
 
 
     def run(self):
@@ -290,24 +197,21 @@ class Battle:
                 self.fa = self.get_force_advantage()
 
         '''
-            returncode
+            returncode for each battle
             0 - A lost
             1 - B lost
             2 - draw both survived
             3 - draw both eliminated
         '''
-        
-        status = None
-        if self.army['A'].units_land.sum() == 0 and self.army['B'].units_land.sum() > 0:
-            status = 0
-        elif self.army['A'].units_land.sum() > 0 and self.army['B'].units_land.sum() == 0:
-            status = 1
-        elif self.army['A'].units_land.sum() > 0 and self.army['B'].units_land.sum() > 0:
-            status = 2
-        elif self.army['A'].units_land.sum() == 0 and self.army['B'].units_land.sum() == 0:
-            status = 3
+        alive_a = self.units_land['A'].sum(axis=1) > 0
+        alive_b = self.units_land['B'].sum(axis=1) > 0
+
+        status = np.full(self.n, 3)
+        status[~alive_a & alive_b] = 0
+        status[alive_a & ~alive_b] = 1
+        status[alive_a & alive_b] = 2
 
-        return (status, self.army['A'].units_land, self.army['B'].units_land)
+        return (status, self.units_land['A'], self.units_land['B'])
 
 
 class Simulate:
@@ -322,11 +226,8 @@ class Simulate:
         self.metrics = {}
 
     def run(self):
-        for n in tqdm(range(self.N)):
-            result = Battle(copy.deepcopy(self.army_a), copy.deepcopy(self.army_b)).run()
-            self.statistics.append(result[0])
-            self.survivors_a.append(result[1])
-            self.survivors_b.append(result[2])
+        # all battles in one go
+        self.statistics, self.survivors_a, self.survivors_b = Battle(self.army_a, self.army_b, self.N).run()
 
         self.eval_statistics()
         self.print_results()
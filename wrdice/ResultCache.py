@@ -0,0 +1,90 @@
+from collections import OrderedDict
+from typing import Optional
+import hashlib
+import pickle
+import time
+
+from wrdice.Army import Army
+from wrdice.CombatConfig import CombatConfig, canonical
+from wrdice.util import CombatSystem
+
+
+class ResultCache:
+    '''
+        cache for simulation results (metrics and outcome histograms)
+        two tiers:
+            memory  -   LRU of the last max_entries results
+            disk    -   sqlite file at path (optional), the least recently used
+                        results are evicted once it holds more than max_bytes
+    '''
+    def __init__(self, path: Optional[str] = None, max_entries: int = 128, max_bytes: int = 64 * 2**20):
+        self.memory = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.db = None
+        if path is not None:
+            # only disk caches need sqlite - keep it out of the import of Simulate
+            import sqlite3
+            self.db = sqlite3.connect(path)
+            self.db.execute('CREATE TABLE IF NOT EXISTS results '
+                            '(key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_used REAL)')
+            self.db.commit()
+
+
+    @staticmethod
+    def key(combat_system: CombatSystem, config: CombatConfig, army_a: Army, army_b: Army, n: int, *extra) -> str:
+        ''' canonical hash of everything that determines a simulation result '''
+        parts = [combat_system.name, config.hash, n]
+        for army in [army_a, army_b]:
+            state, strategy = army.snapshot()
+            parts += [state, strategy]
+        parts += list(extra)
+        return hashlib.sha256(canonical(parts).encode()).hexdigest()
+
+
+    def get(self, key: str):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        if self.db is None:
+            return None
+        row = self.db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute('UPDATE results SET last_used = ? WHERE key = ?', (time.time(), key))
+        self.db.commit()
+        result = pickle.loads(row[0])
+        self.remember(key, result)
+        return result
+
+
+    def put(self, key: str, result) -> None:
+        self.remember(key, result)
+        if self.db is None:
+            return
+
+        value = pickle.dumps(result)
+        self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', (key, value, len(value), time.time()))
+        # evict least recently used results until the file fits
+        total, = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()
+        for old_key, size in self.db.execute('SELECT key, size FROM results ORDER BY last_used').fetchall():
+            if total <= self.max_bytes:
+                break
+            self.db.execute('DELETE FROM results WHERE key = ?', (old_key,))
+            total -= size
+        self.db.commit()
+
+
+    def remember(self, key: str, result) -> None:
+        self.memory[key] = result
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+
+    def clear(self) -> None:
+        self.memory.clear()
+        if self.db is not None:
+            self.db.execute('DELETE FROM results')
+            self.db.commit()
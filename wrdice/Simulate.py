@@ -1,34 +1,105 @@
 import numpy as np
-import copy
 from typing import Optional
 
-from tqdm import tqdm
 from enum import Enum, auto, IntEnum
 from io import StringIO
 import os
 import logging
-import asyncio
+import copy
+import queue
+from collections import deque
+from functools import partial
+from itertools import product, repeat
 
 from wrdice.D12Colored import D12Colored
 from wrdice.util import *
 from wrdice.Army import Army
 from wrdice.Battle import Battle
+from wrdice.CombatConfig import CombatConfig
+from wrdice.ResultCache import ResultCache
+from wrdice.TrialBuffer import TrialBuffer
+from wrdice.OutcomeAggregator import OutcomeAggregator
+from wrdice.Profiler import Profiler, NO_PROFILER
 from wrdice.config import *
+from wrdice import __version__, __git_sha__
 import sys
-import git
 
 def start_sim(in_, out_, q_intermediate):
+    import asyncio
     asyncio.run(Simulator(in_, out_, q_intermediate))
 
 def Simulator(q_in, q_out, q_intermediate):
-    sim = Simulate(None, None)
+    '''
+        simulation worker process - messages on q_in
+            'EXIT'
+            ('CONFIG', config)                                          registers a config under its hash, no reply
+            ('BATCH', job_id, combat_system, config_hash, scenarios)    -> ('BATCH', job_id, probabilities)
+                                                                           see Simulate.run_batch
+            ('RUN', job_id, combat_system, config, army_a, army_b[, run_options])
+                                                                        -> ('RESULT', job_id, report of run_all)
+                                                                           or ('CANCELLED', job_id)
+                                                                           the trials run in chunks, after each one
+                                                                           ('PROGRESS', job_id, Simulate.get_progress())
+                                                                           goes to q_intermediate
+            ('CANCEL', job_id)                                          drops a queued or running job, checked
+                                                                        between chunks
+            (combat_system, config, army_a, army_b)                     -> report of run_all
+    '''
+    sim = Simulate(None, None, cache=ResultCache())
+    # compiled configs by hash
+    configs = {}
+    # messages that arrived while a job was running and the job ids to drop
+    pending = deque()
+    cancelled = set()
+
+    def poll():
+        while True:
+            try:
+                msg = q_in.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(msg, tuple) and msg[0] == 'CANCEL':
+                cancelled.add(msg[1])
+            else:
+                pending.append(msg)
+
     print('Starting Simulator Process')
     while True:
         #n = q_in.coro_get()
-        n = q_in.get()
+        n = pending.popleft() if pending else q_in.get()
         if n == 'EXIT':
             print('exit')
             sys.exit()
+        elif n[0] == 'CANCEL':
+            cancelled.add(n[1])
+            continue
+        elif n[0] == 'RUN':
+            _, job_id, combat_system, config, army_a, army_b, *run_options = n
+            run_options = dict(run_options[0]) if run_options else {}
+            run_options.setdefault('backend', Backend.Vectorized)
+
+            def stop():
+                poll()
+                return job_id in cancelled or 'EXIT' in pending
+
+            msg = ('CANCELLED', job_id)
+            if job_id not in cancelled:
+                sim.reset()
+                report = sim.run_all(combat_system, config, army_a, army_b, q_intermediate,
+                                     job_id=job_id, cancelled=stop, **run_options)
+                if not stop():
+                    msg = ('RESULT', job_id, report)
+            cancelled.discard(job_id)
+        elif n[0] == 'CONFIG':
+            config = CombatConfig.compile(n[1])
+            configs[config.hash] = config
+            continue
+        elif n[0] == 'BATCH':
+            _, job_id, combat_system, config_hash, scenarios = n
+            if config_hash in configs:
+                msg = ('BATCH', job_id, sim.run_batch(combat_system, configs[config_hash], scenarios))
+            else:
+                msg = ('ERROR', job_id, f"unknown config {config_hash} - send it with a CONFIG message first")
         else:
             # new simulation
             combat_system = n[0]
@@ -39,37 +110,134 @@ def Simulator(q_in, q_out, q_intermediate):
             msg = sim.run_all(combat_system, config, army_a, army_b, q_intermediate)
         q_out.put(msg)
 
+def run_shard(combat_system, config, army_a, army_b, n, seed_seq, backend=Backend.Scalar, sampler=Sampler.MonteCarlo, tilt=None,
+              profiler=NO_PROFILER):
+    '''
+        runs n trials with their own random stream - executed in a worker process
+        returns the status of each trial, the survivors as (n, color) arrays and
+        the weights of the trials (None unless the dice are drawn from tilt)
+    '''
+    rng = np.random.default_rng(seed_seq)
+    profiler.count('trials', n)
+
+    if backend == Backend.Vectorized:
+        from wrdice.BatchBattle import BatchBattle
+        with profiler.phase('battle'):
+            dice = None
+            if sampler != Sampler.MonteCarlo or tilt is not None:
+                dice = BatchBattle.draw_dice(D12Colored(config['batch_size'], rng), n, config['batch_size'], sampler, tilt)
+            battle = BatchBattle(army_a, army_b, config, n, rng, dice=dice, dice_p=tilt, profiler=profiler)
+            status = battle.run(combat_system=combat_system)
+        survivors = {side: {type: battle.units[side][type].copy() for type in ['land', 'air', 'sea']} for side in ['A', 'B']}
+        for side in ['A', 'B']:
+            survivors[side]['sea'][:, 0] += battle.submerged[side]
+        return status, survivors, None if tilt is None else battle.weights
+
+    trials = TrialBuffer(n)
+    snapshot_a, snapshot_b = army_a.snapshot(), army_b.snapshot()
+    for _ in range(n):
+        with profiler.phase('restore'):
+            army_a.restore(snapshot_a)
+            army_b.restore(snapshot_b)
+        with profiler.phase('battle'):
+            battle = Battle(army_a, army_b, config, rng, profiler)
+            status = battle.run(combat_system=combat_system)
+        trials.add(status, battle.army)
+
+    army_a.restore(snapshot_a)
+    army_b.restore(snapshot_b)
+    return trials.status, trials.survivors, None
+
+
+def run_cell(combat_system, config, army_a, army_b, n, seed_seq, backend=Backend.Vectorized):
+    ''' outcome probabilities of one matchup in the order of intermediate_statistics - sweep worker '''
+    if backend == Backend.Exact:
+        from wrdice.ExactBattle import ExactBattle
+        battle = ExactBattle(army_a, army_b, config)
+        counts = np.bincount(battle.run(combat_system=combat_system), weights=battle.p, minlength=4)
+    else:
+        status, _, _ = run_shard(combat_system, config, army_a, army_b, n, seed_seq, backend)
+        counts = np.bincount(status, minlength=4)
+    return counts[[1, 0, 2, 3]] / counts.sum()
+
+
+def pack_scenario(army_a: Army, army_b: Army) -> np.ndarray:
+    '''
+        compact int16 form of a matchup - (side, 47)
+        units and units_by_stance of each army (Army.buffer[:45]) followed by the
+        values of its air and ground strategy (0 for None)
+    '''
+    rows = []
+    for army in [army_a, army_b]:
+        strategy = [0 if army.strategy[key] is None else army.strategy[key].value for key in ['air', 'ground']]
+        rows.append(np.concatenate((army.buffer[:45], strategy)))
+    return np.array(rows, dtype=np.int16)
+
+
+def unpack_scenario(scenario, config):
+    ''' pack_scenario -> (army_a, army_b) '''
+    armies = []
+    for row in np.asarray(scenario).reshape(2, -1):
+        # buffer order land, sea, air
+        units = row[0:15].reshape(3, 5)
+        stance = row[15:45].reshape(3, 2, 5)
+        army = Army(units[0], units[2], units[1], config)
+        army.apply_stance(stance[0], stance[2], stance[1])
+        army.set_strategy(*[None if code == 0 else Strategy(code) for code in row[45:47]])
+        armies.append(army)
+    return armies
+
+
+def make_army(spec, config) -> Army:
+    '''
+        army from a dict of the Army / apply_stance arguments
+            units_land, units_air, units_sea, stance_land, stance_air, stance_sea
+            strategy (optional)     (air strategy, ground strategy)
+    '''
+    army = Army(spec['units_land'], spec['units_air'], spec['units_sea'], config)
+    army.apply_stance(spec['stance_land'], spec['stance_air'], spec['stance_sea'])
+    if 'strategy' in spec:
+        army.set_strategy(*spec['strategy'])
+    return army
+
+
 class Simulate:
     def __init__(self, 
                     army_a: Optional[Army], 
                     army_b: Optional[Army], 
                     config = None,
-                    combat_system: Optional[CombatSystem] = None):
-        with open(os.path.join(os.path.dirname(__file__), '../version')) as f:
-            version = f.read().rstrip(os.linesep)
-            repo = git.Repo(search_parent_directories=True)
-            sha = repo.head.object.hexsha
-            print(f"Using WRDice v.{version} - {sha[:8]}")
-        
+                    combat_system: Optional[CombatSystem] = None,
+                    rng = None,
+                    cache: Optional[ResultCache] = None):
+        logging.info(f"Using WRDice v.{__version__}" + (f" - {__git_sha__[:8]}" if __git_sha__ else ""))
 
 
         self.N = 2500
+        # trials per seeded shard - fixed so results do not depend on the number of workers
+        self.shard_size = 250
+        # upper bound on the trials of a run with a target precision
+        self.max_N = 100000
         self.army_a = army_a
         self.army_b = army_b
         self.battle_type = 'land'
         self.combat_system = combat_system
         self.config = config
-
-        self.statistics = []
-        self.survivors = {'A':{'land':[],
-                                'air':[],
-                                'sea':[]},
-                          'B':{'land':[],
-                                'air':[],
-                                'sea':[]}}
+        # numpy Generator or seed for the dice of all battles
+        self.rng = np.random.default_rng(rng)
+        # results of run_all are looked up here first
+        self.cache = cache
+
+        # status and survivors of every trial
+        self.trials = TrialBuffer()
+        # running counts and survivor tables the reports are built from
+        self.aggregator = OutcomeAggregator()
+        # a Profiler instruments every run, see profile
+        self.profiler = NO_PROFILER
 
         self.metrics = {}
         self.stats = np.zeros(4)
+        # sum of the squared trial weights per outcome - equal to stats while every trial weighs 1
+        self.stats_sq = np.zeros(4)
         self.moving_std = np.zeros(4)
         self.moving_mean  = np.zeros(4)
         self.M2 = 0
@@ -80,20 +248,34 @@ class Simulate:
         self.army_a = None
         self.army_b = None
 
-        self.statistics = []
-        self.survivors = {'A':{'land':[],
-                                'air':[],
-                                'sea':[]},
-                          'B':{'land':[],
-                                'air':[],
-                                'sea':[]}}
+        self.trials.clear()
+        self.aggregator = OutcomeAggregator()
         self.stats = np.zeros(4)
+        self.stats_sq = np.zeros(4)
         self.moving_std = np.zeros(4)
         self.moving_mean  = np.zeros(4)
         self.M2 = 0
         self.metrics = {}
 
 
+    @property
+    def statistics(self) -> np.ndarray:
+        ''' returncode of every trial '''
+        return self.trials.status
+
+
+    @property
+    def weights(self):
+        ''' probability (Exact) or likelihood ratio (tilt) of each trial - None for plain sampled trials '''
+        return self.trials.weights
+
+
+    @property
+    def survivors(self):
+        ''' survivors[side][type] (trial, color) units left after every trial '''
+        return self.trials.survivors
+
+
     def update_battle_type(self):
         self.battle_type = 'land'
         if self.army_a is not None and self.army_b is not None:
@@ -113,28 +295,31 @@ class Simulate:
 
         if self.combat_system is CombatSystem.WarRoomV2 and self.config is None:
             logging.warning("NO CONFIG provided falling back to default config!!!!")
-            self.config = wr20_vaniilla_options
+            self.config = wr20_vaniilla_config
         elif self.config is None:
             raise RuntimeError("No Config for combat system found")
+        self.config = CombatConfig.compile(self.config)
 
 
+        snapshot_a, snapshot_b = self.army_a.snapshot(), self.army_b.snapshot()
+        self.trials.reserve(self.N)
         for n in (range(self.N)):
             self.cur_n = n
-            battle = Battle(copy.deepcopy(self.army_a), 
-                            copy.deepcopy(self.army_b),
-                            self.config)
+            # every trial starts from the initial armies
+            self.army_a.restore(snapshot_a)
+            self.army_b.restore(snapshot_b)
+            battle = Battle(self.army_a, self.army_b, self.config, self.rng)
             status = battle.run(combat_system=self.combat_system)
             
             abrt = self.running_stats(status)
-            self.statistics.append(status)
-
-            for side in ['A', 'B']:
-                for type in ['land', 'air', 'sea']:
-                    self.survivors[side][type].append(battle.army[side].units[type])
+            self.trials.add(status, battle.army)
+            self.aggregator.add(status, battle.army)
 
             app.spinner.value = int(n / self.N * 100 )
 
             if abrt or n+1 == self.N:
+                self.army_a.restore(snapshot_a)
+                self.army_b.restore(snapshot_b)
                 app.spinner.value = 100
                 app.spinner.stop()
 
@@ -157,7 +342,14 @@ class Simulate:
 
 
 
-    def run_all(self, combat_system: CombatSystem, config=None,  armyA: Optional[Army]=None, armyB: Optional[Army]=None, q_intermediate=None) -> StringIO:
+    def run_all(self, combat_system: CombatSystem, config=None,  armyA: Optional[Army]=None, armyB: Optional[Army]=None, q_intermediate=None,
+                job_id=None, cancelled=None, **run_options) -> StringIO:
+        '''
+            runs a simulation and returns its report - run_options are passed to run
+            with q_intermediate or cancelled the trials run in chunks, after every chunk
+            ('PROGRESS', job_id, get_progress()) goes to q_intermediate and the run
+            stops once cancelled() is true
+        '''
         if armyA is not None:
             self.army_a = armyA
         if armyB is not None:
@@ -165,16 +357,67 @@ class Simulate:
 
         self.update_battle_type()
 
-        ret = self.run(combat_system, config, q_intermediate)
-        if ret:
-            self.eval_statistics()
-            msg = self.get_report()
-            return msg
-        else:
+        key = None
+        if self.cache is not None:
+            config = self.get_config(combat_system, config)
+            key = self.cache.key(combat_system, config, self.army_a, self.army_b, self.N, *([run_options] if run_options else []))
+            result = self.cache.get(key)
+            if result is not None:
+                self.set_result(result)
+                return self.get_report()
+
+        callback = None
+        if q_intermediate is not None or cancelled is not None:
+            def callback():
+                if q_intermediate is not None:
+                    q_intermediate.put(('PROGRESS', job_id, self.get_progress()))
+                return cancelled is not None and cancelled()
+
+        self.run(combat_system, config, callback=callback, **run_options)
+        if len(self.trials) == 0 or (cancelled is not None and cancelled()):
             return None
 
+        self.eval_statistics()
+        if key is not None:
+            self.cache.put(key, self.get_result())
+        return self.get_report()
+
+
+    def get_progress(self) -> dict:
+        ''' partial result of a running simulation '''
+        return {'n': len(self.trials),
+                'counts': self.stats.copy(),
+                'p': self.intermediate_statistics(),
+                'interval': self.get_confidence_intervals()}
+
+
+    def get_result(self):
+        ''' evaluated result of a run - metrics and the outcome histogram, copied so the cache does not share them '''
+        return {'metrics': copy.deepcopy(self.metrics),
+                'stats': self.stats.copy(),
+                'stats_sq': self.stats_sq.copy(),
+                'cur_n': self.cur_n}
+
+
+    def set_result(self, result):
+        # eval_statistics updates metrics in place - keep the cached entry intact
+        self.metrics = copy.deepcopy(result['metrics'])
+        self.stats = result['stats'].copy()
+        self.stats_sq = result.get('stats_sq', result['stats']).copy()
+        self.cur_n = result['cur_n']
+
+
+    def get_config(self, combat_system: CombatSystem, config=None) -> CombatConfig:
+        if combat_system is CombatSystem.WarRoomV2 and config is None:
+            logging.warning("NO CONFIG provided falling back to default config!!!!")
+            config = wr20_vaniilla_config
+        elif config is None:
+            raise RuntimeError("No Config for combat system found")
+        return CombatConfig.compile(config)
+
     def running_stats(self, status, eps=0.5, min_run=500):
         self.stats[status] += 1
+        self.stats_sq[status] += 1
         N = (self.cur_n + 1)
         x = self.stats / N
 
@@ -200,8 +443,22 @@ class Simulate:
 
 
 
-    def run(self, combat_system: CombatSystem, config=None, armyA: Optional[Army]=None, armyB: Optional[Army]=None) -> int:
-        
+    def run(self, combat_system: CombatSystem, config=None, armyA: Optional[Army]=None, armyB: Optional[Army]=None,
+            backend: Backend = Backend.Scalar, workers: int = 1, seed: Optional[int] = None,
+            precision: Optional[float] = None, confidence: float = 0.95, interval: Interval = Interval.Wilson,
+            sampler: Sampler = Sampler.MonteCarlo, tilt=None, callback=None) -> int:
+        '''
+            runs N trials (Exact: the full outcome distribution)
+            with a precision the run instead continues in chunks of shard_size trials
+            until every outcome probability is known to +-precision at the given
+            confidence, at most max_N trials
+            sampler selects a variance reduced way to draw the dice (vectorized backend)
+            tilt are face probabilities to draw the dice from instead of D12Colored.p,
+            for both sides or {side: p} - importance sampling of rare outcomes, every
+            trial is weighted by its likelihood ratio (vectorized backend)
+            callback() is called after every chunk of shard_size trials, the run stops
+            when it returns True
+        '''
         if armyA is not None:
             self.army_a = armyA
         if armyB is not None:
@@ -217,40 +474,450 @@ class Simulate:
         if troops_a == 0 or troops_b == 0:
             return
 
-        if combat_system is CombatSystem.WarRoomV2 and config is None:
-            logging.warning("NO CONFIG provided falling back to default config!!!!")
-            config = wr20_vaniilla_options
-        elif config is None:
-            raise RuntimeError("No Config for combat system found")
+        config = self.get_config(combat_system, config)
+        if sampler != Sampler.MonteCarlo and backend != Backend.Vectorized:
+            raise NotImplementedError(f"{sampler} is only supported by the vectorized backend")
+        if tilt is not None and (backend != Backend.Vectorized or sampler == Sampler.Stratified):
+            raise NotImplementedError("tilted dice are only supported by the vectorized backend without stratification")
+
+        if backend == Backend.Exact:
+            self.run_exact(combat_system, config)
+        elif precision is not None or callback is not None:
+            self.run_adaptive(combat_system, config, backend, precision, confidence, interval, sampler, tilt, callback,
+                              workers, seed)
+        elif workers > 1 or seed is not None:
+            self.run_parallel(combat_system, config, backend, workers, seed, sampler, tilt)
+        elif backend == Backend.Vectorized:
+            self.run_vectorized(combat_system, config, sampler, tilt)
+        else:
+            self.run_scalar(combat_system, config)
+        self.profiler.emit()
+
 
-        for n in tqdm(range(self.N)):
+    def run_scalar(self, combat_system: CombatSystem, config):
+        ''' runs up to N trials one Battle at a time, stops early once the outcome estimates settled '''
+        profiler = self.profiler
+        snapshot_a, snapshot_b = self.army_a.snapshot(), self.army_b.snapshot()
+        self.trials.reserve(self.N)
+        for n in progress_bar(range(self.N)):
             self.cur_n = n
-            battle = Battle(copy.deepcopy(self.army_a), 
-                            copy.deepcopy(self.army_b),
-                            config)
-            status = battle.run(combat_system=combat_system)
+            profiler.count('trials')
+            # every trial starts from the initial armies
+            with profiler.phase('restore'):
+                self.army_a.restore(snapshot_a)
+                self.army_b.restore(snapshot_b)
+            with profiler.phase('battle'):
+                battle = Battle(self.army_a, self.army_b, config, self.rng, profiler)
+                status = battle.run(combat_system=combat_system)
             #print(status)
-            abrt = self.running_stats(status)
-            self.statistics.append(status)
-            print(battle.army['B'].units['air'])
-
-            for side in ['A', 'B']:
-                for type in ['land', 'air', 'sea']:
-                    self.survivors[side][type].append(battle.army[side].units[type])
-
-                    if type == 'sea' and battle.army[side].submerged > 0:
-                        self.survivors[side][type][-1][0] += battle.army[side].submerged
+            with profiler.phase('record'):
+                abrt = self.running_stats(status)
+                self.trials.add(status, battle.army)
+                self.aggregator.add(status, battle.army)
             if abrt:
+                break
+
+        self.army_a.restore(snapshot_a)
+        self.army_b.restore(snapshot_b)
+
+
+    def profile(self, combat_system: CombatSystem, config=None, trace_memory: bool = False, hooks=(), **run_options) -> dict:
+        '''
+            runs a simulation and eval_statistics with a fresh Profiler and returns its report
+            run_options are passed to run, hooks are called with the report after the run
+            (and every chunk of an adaptive one) - the profiler stays in self.profiler,
+            format_report prints it as a table
+        '''
+        self.profiler = Profiler(trace_memory, hooks)
+        if trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+        try:
+            self.run(combat_system, config, **run_options)
+            if len(self.trials):
+                self.eval_statistics()
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+        return self.profiler.report()
+
+
+    def run_vectorized(self, combat_system: CombatSystem, config, sampler: Sampler = Sampler.MonteCarlo, tilt=None):
+        '''
+            runs all N trials at once with the BatchBattle engine
+            fills statistics and survivors the same way run does
+        '''
+        self.add_trials(*run_shard(combat_system, config, self.army_a, self.army_b, self.N, self.rng, Backend.Vectorized, sampler, tilt,
+                                   self.profiler))
+
+
+    def run_adaptive(self, combat_system: CombatSystem, config, backend: Backend,
+                     precision: Optional[float], confidence: float, interval: Interval, sampler: Sampler = Sampler.MonteCarlo,
+                     tilt=None, callback=None, workers: int = 1, seed: Optional[int] = None):
+        '''
+            runs chunks of shard_size trials
+            with a precision until the widest confidence interval of the outcome
+            probabilities is within +-precision (at most max_N trials), otherwise N trials
+            stops early once callback() returns True
+            with a seed chunk i draws from the i-th stream spawned from it, the same as
+            shard i of run_parallel - with workers > 1 a round of workers chunks runs on
+            a process pool and the chunks are checked in order, so a fixed seed gives the
+            same result for any number of workers
+        '''
+        limit = self.N if precision is None else self.max_N
+        if seed is None and workers > 1:
+            seed = self.rng.integers(2**63)
+        seed_seq = None if seed is None else np.random.SeedSequence(seed)
+
+        pool = None
+        if workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            pool = ProcessPoolExecutor(max_workers=workers)
+        try:
+            while len(self.trials) < limit:
+                sizes = []
+                queued = len(self.trials)
+                while len(sizes) < workers and queued < limit:
+                    sizes.append(min(self.shard_size, limit - queued))
+                    queued += sizes[-1]
+                seeds = [self.rng] * len(sizes) if seed_seq is None else seed_seq.spawn(len(sizes))
+                args = (repeat(combat_system), repeat(config), repeat(self.army_a), repeat(self.army_b),
+                        sizes, seeds, repeat(backend), repeat(sampler), repeat(tilt))
+
+                if pool is not None:
+                    # the workers are not instrumented, only the time waiting for them
+                    self.profiler.count('trials', sum(sizes))
+                    with self.profiler.phase('battle'):
+                        results = list(pool.map(run_shard, *args))
+                else:
+                    results = map(run_shard, *args, repeat(self.profiler))
+
+                for result in results:
+                    self.add_trials(*result)
+                    self.profiler.count('chunks')
+                    self.profiler.emit()
+
+                    if callback is not None and callback():
+                        return
+                    if precision is not None:
+                        low, high = self.get_confidence_intervals(confidence, interval).T
+                        if np.max(high - low) / 2 <= precision:
+                            return
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+
+    def add_trials(self, status, survivors, weights=None):
+        ''' appends a block of trials as returned by run_shard '''
+        with self.profiler.phase('record'):
+            self.cur_n = len(self.trials) + len(status) - 1
+            self.stats += np.bincount(status, weights=weights, minlength=4)
+            self.stats_sq += np.bincount(status, weights=None if weights is None else weights**2, minlength=4)
+            self.trials.extend(status, survivors, weights)
+            self.aggregator.extend(status, survivors, weights)
+
+
+    def run_parallel(self, combat_system: CombatSystem, config, backend: Backend, workers: int, seed: Optional[int],
+                     sampler: Sampler = Sampler.MonteCarlo, tilt=None):
+        '''
+            splits the N trials into shards with independent random streams spawned
+            from seed and runs them on a pool of worker processes
+            shards are merged in order, so a fixed seed gives the same result for any
+            number of workers
+        '''
+        sizes = [min(self.shard_size, self.N - start) for start in range(0, self.N, self.shard_size)]
+        if seed is None:
+            seed = self.rng.integers(2**63)
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        args = (repeat(combat_system), repeat(config), repeat(self.army_a), repeat(self.army_b),
+                sizes, seeds, repeat(backend), repeat(sampler), repeat(tilt))
+
+        if workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            # the workers are not instrumented, only the time waiting for them
+            self.profiler.count('trials', self.N)
+            with self.profiler.phase('battle'), ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(run_shard, *args))
+        else:
+            results = map(run_shard, *args, repeat(self.profiler))
+
+        self.trials.reserve(self.N)
+        n = 0
+        for status, survivors, weights in results:
+            if backend == Backend.Scalar:
+                # same early stopping as the sequential run
+                for i in range(len(status)):
+                    self.cur_n = n + i
+                    abrt = self.running_stats(status[i])
+                    if abrt:
+                        break
+                stop = i + 1
+                survivors = {side: {type: units[:stop] for type, units in s.items()} for side, s in survivors.items()}
+                self.trials.extend(status[:stop], survivors)
+                self.aggregator.extend(status[:stop], survivors)
+                if abrt:
+                    return
+            else:
+                self.add_trials(status, survivors, weights)
+            n += len(status)
+
+
+    def sweep(self, combat_system: CombatSystem, army_a: dict, army_b: dict, grid: dict, config=None, n: Optional[int] = None,
+              backend: Backend = Backend.Vectorized, workers: int = 1, seed: Optional[int] = None, callback=None) -> np.ndarray:
+        '''
+            outcome probabilities for every cell of a grid of matchups
+            army_a, army_b  base armies as make_army specs
+            grid            {(side, field): values} replaces a whole spec entry, e.g. stance assignments
+                            {(side, field, index): values} sets one entry, e.g. ('A', 'units_land', COLOR.YELLOW)
+            returns the cube (len(values) for each axis..., outcome) in the order of intermediate_statistics
+            cells are scheduled on a pool of workers and written to the cube as they finish,
+            callback(cell index, probabilities) is called for each of them
+            identical cells are simulated once, cells in the result cache not at all,
+            cells whose stances do not add up to the units stay nan
+        '''
+        config = self.get_config(combat_system, config)
+        n = self.N if n is None else n
+        axes = list(grid.items())
+        shape = tuple(len(values) for _, values in axes)
+        cube = np.full(shape + (4,), np.nan)
+        if seed is None:
+            seed = self.rng.integers(2**63)
+        # one stream per cell, independent of the number of workers
+        seeds = np.random.SeedSequence(seed).spawn(int(np.prod(shape)))
+
+        # key -> (run_cell arguments, cell indices)
+        tasks = {}
+        for flat, idx in enumerate(np.ndindex(*shape)):
+            specs = {'A': copy.deepcopy(army_a), 'B': copy.deepcopy(army_b)}
+            for ((side, field, *index), values), i in zip(axes, idx):
+                if index:
+                    entry = np.array(specs[side][field])
+                    entry[index[0]] = values[i]
+                    specs[side][field] = entry
+                else:
+                    specs[side][field] = values[i]
+            try:
+                a, b = make_army(specs['A'], config), make_army(specs['B'], config)
+            except RuntimeError:
+                continue
+
+            key = ResultCache.key(combat_system, config, a, b, n, 'cell', backend.name)
+            result = self.cache.get(key) if self.cache is not None else None
+            if result is not None:
+                cube[idx] = result
+                if callback is not None:
+                    callback(idx, result)
+            elif key in tasks:
+                tasks[key][1].append(idx)
+            else:
+                tasks[key] = ((combat_system, config, a, b, n, seeds[flat], backend), [idx])
+
+        def store(key, get_result):
+            try:
+                result = get_result()
+            except RuntimeError as e:
+                logging.warning(f"sweep cell skipped: {e}")
                 return
+            if self.cache is not None:
+                self.cache.put(key, result)
+            for idx in tasks[key][1]:
+                cube[idx] = result
+                if callback is not None:
+                    callback(idx, result)
+
+        if workers > 1:
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(run_cell, *args): key for key, (args, _) in tasks.items()}
+                for future in as_completed(futures):
+                    store(futures[future], future.result)
+        else:
+            for key, (args, _) in tasks.items():
+                store(key, partial(run_cell, *args))
+        return cube
+
+
+    def compare(self, combat_system: CombatSystem, variants, config=None, n: Optional[int] = None,
+                outcome: int = 0, confidence: float = 0.95, seed: Optional[int] = None) -> dict:
+        '''
+            runs every variant (army_a, army_b) of one matchup - e.g. with another strategy
+            or stance split - on the same pre-drawn dice with the vectorized engine
+            returns
+                p           (variant, outcome) outcome probabilities in the order of intermediate_statistics
+                difference  (variant,) paired difference of the probability of outcome to the first variant
+                interval    (variant, 2) confidence interval of the difference
+        '''
+        from statistics import NormalDist
+        from wrdice.BatchBattle import BatchBattle
+        config = self.get_config(combat_system, config)
+        n = self.N if n is None else n
+        rng = self.rng if seed is None else np.random.default_rng(seed)
+        dice = BatchBattle.draw_dice(D12Colored(config['batch_size'], rng), n, config['batch_size'])
+
+        order = [1, 0, 2, 3]
+        p, hits = [], []
+        for army_a, army_b in variants:
+            status = BatchBattle(army_a, army_b, config, n, rng, dice=dice).run(combat_system=combat_system)
+            p.append(np.bincount(status, minlength=4)[order] / n)
+            hits.append(status == order[outcome])
+
+        # per trial differences - the shared dice cancel out of their variance
+        delta = np.array(hits, dtype=float) - hits[0]
+        difference = delta.mean(axis=1)
+        half = NormalDist().inv_cdf(1 - (1 - confidence) / 2) * delta.std(axis=1, ddof=1) / np.sqrt(n)
+        return {'p': np.array(p),
+                'difference': difference,
+                'interval': np.stack((difference - half, difference + half), axis=1)}
+
+
+    def run_batch(self, combat_system: CombatSystem, config, scenarios) -> np.ndarray:
+        '''
+            outcome probabilities (scenario, outcome) of packed scenarios (see pack_scenario)
+            in the order of intermediate_statistics - N vectorized trials each,
+            identical and cached scenarios are not simulated again
+        '''
+        config = self.get_config(combat_system, config)
+        scenarios = np.asarray(scenarios, dtype=np.int16)
+        unique, inverse = np.unique(scenarios.reshape(len(scenarios), -1), axis=0, return_inverse=True)
+
+        results = np.zeros((len(unique), 4))
+        for i, scenario in enumerate(unique):
+            army_a, army_b = unpack_scenario(scenario, config)
+            key = None
+            if self.cache is not None:
+                key = ResultCache.key(combat_system, config, army_a, army_b, self.N, 'cell', Backend.Vectorized.name)
+                cached = self.cache.get(key)
+                if cached is not None:
+                    results[i] = cached
+                    continue
+            results[i] = run_cell(combat_system, config, army_a, army_b, self.N, self.rng, Backend.Vectorized)
+            if key is not None:
+                self.cache.put(key, results[i].copy())
+        return results[inverse.ravel()]
+
+
+    @staticmethod
+    def stance_splits(army: dict, types=('land', 'air', 'sea')):
+        ''' every split of the units of types between STANCE.AIR and STANCE.GROUND as stance_<type> entries '''
+        units = [(T, color, count) for T in types for color, count in enumerate(army[f'units_{T}']) if count > 0]
+        for split in product(*[range(count + 1) for _, _, count in units]):
+            stances = {f'stance_{T}': [[0] * 5, [0] * 5] for T in types}
+            for (T, color, count), in_air in zip(units, split):
+                stances[f'stance_{T}'][STANCE.AIR][color] = in_air
+                stances[f'stance_{T}'][STANCE.GROUND][color] = count - in_air
+            yield stances
+
+
+    def optimize_stance(self, combat_system: CombatSystem, army: dict, opponent: dict, side: str = 'A', config=None,
+                        types=('land', 'air', 'sea'), backend: Backend = Backend.Vectorized, n_min: int = 100, eta: int = 3,
+                        max_n: Optional[int] = None, workers: int = 1, seed: Optional[int] = None,
+                        confidence: float = 0.95, interval: Interval = Interval.Wilson):
+        '''
+            searches the stance split of army with the highest win probability against opponent
+            army, opponent  make_army specs, the stances of types are searched
+            side            side army fights on
+            Exact           every split is solved exactly
+            otherwise       successive halving - every split gets n_min trials, the best 1/eta
+                            get eta times as many more and so on, until one split is left
+                            or the leader would exceed max_n trials
+            returns the spec of the best split, its win probability and confidence interval
+        '''
+        config = self.get_config(combat_system, config)
+        max_n = 4 * self.N if max_n is None else max_n
+        win = 1 if side == 'A' else 0
+
+        specs = [dict(army, **stances) for stances in self.stance_splits(army, types)]
+        other = make_army(opponent, config)
+        battles = [(make_army(spec, config), other) if side == 'A' else (other, make_army(spec, config)) for spec in specs]
+        counts = np.zeros((len(specs), 4))
+
+        if backend == Backend.Exact:
+            from wrdice.ExactBattle import ExactBattle
+            for i, (army_a, army_b) in enumerate(battles):
+                battle = ExactBattle(army_a, army_b, config)
+                counts[i] = np.bincount(battle.run(combat_system=combat_system), weights=battle.p, minlength=4)
+            best = np.argmax(counts[:, win])
+            p_win = float(counts[best, win])
+            return specs[best], p_win, (p_win, p_win)
+
+        if seed is None:
+            seed = self.rng.integers(2**63)
+        seed_seq = np.random.SeedSequence(seed)
+        pool = None
+        if workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            pool = ProcessPoolExecutor(max_workers=workers)
+        try:
+            alive = np.arange(len(specs))
+            n = n_min
+            while True:
+                args = (repeat(combat_system), repeat(config), [battles[i][0] for i in alive], [battles[i][1] for i in alive],
+                        repeat(n), seed_seq.spawn(len(alive)), repeat(backend))
+                results = pool.map(run_shard, *args) if pool is not None else map(run_shard, *args)
+                for i, (status, _, _) in zip(alive, results):
+                    counts[i] += np.bincount(status, minlength=4)
+
+                ranking = alive[np.argsort(counts[alive, win] / counts[alive].sum(axis=1))[::-1]]
+                n *= eta
+                if len(alive) == 1 or counts[ranking[0]].sum() + n > max_n:
+                    break
+                alive = ranking[:int(np.ceil(len(alive) / eta))]
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        best = ranking[0]
+        n_best = counts[best].sum()
+        low, high = binomial_interval(counts[best, win], n_best, confidence, interval)
+        return specs[best], float(counts[best, win] / n_best), (float(low), float(high))
+
+
+    def run_exact(self, combat_system: CombatSystem, config):
+        '''
+            computes the exact outcome distribution with the ExactBattle solver
+            every distinct outcome is stored once with its probability as weight
+        '''
+        from wrdice.ExactBattle import ExactBattle
+        with self.profiler.phase('battle'):
+            battle = ExactBattle(self.army_a, self.army_b, config)
+            status = battle.run(combat_system=combat_system)
+
+        survivors = {side: {type: battle.units[side][type].copy() for type in ['land', 'air', 'sea']} for side in ['A', 'B']}
+        for side in ['A', 'B']:
+            survivors[side]['sea'][:, 0] += battle.submerged[side]
+        self.add_trials(status, survivors, battle.p)
 
 
     def intermediate_statistics(self):
-        N = (self.cur_n + 1)
-        x = self.stats / N
+        x = self.stats / self.stats.sum()
         x[np.isnan(x)] = 0
         return np.array([x[1],x[0],x[2],x[3]])
 
 
+    def get_confidence_intervals(self, confidence: float = 0.95, interval: Interval = Interval.Wilson) -> np.ndarray:
+        '''
+            (outcome, low/high) confidence intervals of the outcome probabilities
+            in the order of intermediate_statistics
+            weighted trials (tilt) count with the effective sample size of each outcome,
+            n_eff = p (1 - p) / var with the variance of the self normalized estimate
+        '''
+        total = self.stats.sum()
+        if np.array_equal(self.stats, self.stats_sq) or total == 0:
+            low, high = binomial_interval(self.stats, total, confidence, interval)
+        else:
+            p = self.stats / total
+            var = (self.stats_sq * (1 - p)**2 + (self.stats_sq.sum() - self.stats_sq) * p**2) / total**2
+            # an outcome without spread falls back to the effective sample size of all trials
+            kish = total**2 / self.stats_sq.sum()
+            n_eff = np.divide(p * (1 - p), var, out=np.full(4, kish), where=(var > 0) & (p > 0) & (p < 1))
+            low, high = np.zeros(4), np.ones(4)
+            for i in range(4):
+                low[i], high[i] = binomial_interval(p[i] * n_eff[i], n_eff[i], confidence, interval)
+        order = [1, 0, 2, 3]
+        return np.stack((low[order], high[order]), axis=1)
+
+
     def intermediate_statistics_as_text(self):
         x = self.intermediate_statistics()
         report = StringIO(newline=os.linesep)
@@ -265,99 +932,30 @@ class Simulate:
 
 
     def eval_statistics(self):
-        # eval
-        idx, count = np.unique(self.statistics, return_counts=True)
-        stats = np.zeros(4)
-        stats[idx] = count
-        stats /= (self.cur_n+1)
-        self.statistics = np.array(self.statistics)
-
-        self.survivors_a_ground = np.array(self.survivors['A'][self.battle_type])
-        self.survivors_b_ground = np.array(self.survivors['B'][self.battle_type])
-
-        self.survivors_a_air = np.array(self.survivors['A']['air'])
-        self.survivors_b_air = np.array(self.survivors['B']['air'])
-
-        self.survivors_a = np.concatenate((self.survivors_a_ground, self.survivors_a_air), 1)
-        self.survivors_b = np.concatenate((self.survivors_b_ground, self.survivors_b_air), 1)
-
-        idx_games_won_b = np.argwhere(self.statistics==0)
-        idx_games_won_a = np.argwhere(self.statistics==1)
-        idx_games_draw  = np.argwhere(self.statistics==2)
-        idx_games_won_none = np.argwhere(self.statistics==3)
-
-        avg_surv_a   = np.squeeze(np.mean(self.survivors_a[idx_games_won_a], 0))    if idx_games_won_a.any()    else np.zeros(10)
-        avg_surv_b   = np.squeeze(np.mean(self.survivors_b[idx_games_won_b], 0))    if idx_games_won_b.any()    else np.zeros(10)
-        avg_draw_a   = np.squeeze(np.mean(self.survivors_a[idx_games_draw], 0))     if idx_games_draw.any()     else np.zeros(10)
-        avg_draw_b   = np.squeeze(np.mean(self.survivors_b[idx_games_draw], 0))     if idx_games_draw.any()     else np.zeros(10)
-
-        self.metrics['avg_surv_a'] = avg_surv_a
-        self.metrics['avg_surv_b'] = avg_surv_b
-        self.metrics['avg_draw_a'] = avg_draw_a
-        self.metrics['avg_draw_b'] = avg_draw_b
-
-        games_won_a     = 0 if not idx_games_won_a.any()    else len(idx_games_won_a)
-        games_won_b     = 0 if not idx_games_won_b.any()    else len(idx_games_won_b)
-        games_draw      = 0 if not idx_games_draw.any()     else len(idx_games_draw)
-        games_won_none  = 0 if not idx_games_won_none.any() else len(idx_games_won_none)
-
-        self.metrics['games_won_a'] = games_won_a
-        self.metrics['games_won_b'] = games_won_b
-        self.metrics['games_won_none'] = games_won_none
-        self.metrics['games_draw'] = games_draw
-
-
-        def top_variations(games, N=10):
-            variations, counts = np.unique(games, axis=0, return_counts=True)
-            sorting = np.argsort(counts)
-            N = min(N, len(variations))
-            top_variations = variations[sorting][::-1][:N]
-            percentages = (counts[sorting][::-1][:N] / len(games))
-
-            if len(top_variations.shape) > 2:
-                top_variations = np.squeeze(top_variations)
-            if len(percentages.shape) > 2:
-                percentages = np.squeeze(percentages)
-            
-            # for only one variation add count dimension
-            if len(top_variations.shape) == 1:
-                top_variations = top_variations[None, :]
-            return top_variations.astype(int), percentages
-        
-        top_varations_won_a, distr_won_a = top_variations(self.survivors_a[idx_games_won_a])
-        top_varations_won_b, distr_won_b = top_variations(self.survivors_b[idx_games_won_b])
-        top_varations_draw_a, distr_draw_a = top_variations(self.survivors_a[idx_games_draw])
-        top_varations_draw_b, distr_draw_b = top_variations(self.survivors_b[idx_games_draw])
-
-
-        units_a = np.array(self.survivors['A'][self.battle_type])
-        units_b = np.array(self.survivors['B'][self.battle_type])
-        units_a_air = np.array(self.survivors['A']['air'])
-        units_b_air = np.array(self.survivors['B']['air'])
-
-        def unit_hist(arr):
-            stats = []
-            for i in range(arr.shape[1]):
-                num, cnt = np.unique(arr[:,i], return_counts=True)
-                cnt = cnt / arr.shape[0]
-                stats.append((num,cnt))
-            return stats
+        ''' report metrics from the running tables of the aggregator - O(distinct outcomes) '''
+        with self.profiler.phase('statistics'):
+            agg = self.aggregator
+            self.metrics['n'] = agg.counts.sum()
 
-        stats_a_ground = unit_hist(units_a)
-        stats_b_ground = unit_hist(units_b)
-        stats_a_air = unit_hist(units_a_air)
-        stats_b_air = unit_hist(units_b_air)
+            self.metrics['avg_surv_a'] = agg.average('A', 1, self.battle_type)
+            self.metrics['avg_surv_b'] = agg.average('B', 0, self.battle_type)
+            self.metrics['avg_draw_a'] = agg.average('A', 2, self.battle_type)
+            self.metrics['avg_draw_b'] = agg.average('B', 2, self.battle_type)
 
-        self.metrics['stats_a_ground'] = stats_a_ground
-        self.metrics['stats_b_ground'] = stats_b_ground
-        self.metrics['stats_a_air'] = stats_a_air
-        self.metrics['stats_b_air'] = stats_b_air
+            self.metrics['games_won_a'] = agg.counts[1]
+            self.metrics['games_won_b'] = agg.counts[0]
+            self.metrics['games_won_none'] = agg.counts[3]
+            self.metrics['games_draw'] = agg.counts[2]
 
+            self.metrics['stats_a_ground'] = agg.unit_hist('A', self.battle_type)
+            self.metrics['stats_b_ground'] = agg.unit_hist('B', self.battle_type)
+            self.metrics['stats_a_air'] = agg.unit_hist('A', 'air')
+            self.metrics['stats_b_air'] = agg.unit_hist('B', 'air')
 
-        self.metrics['outcomes_won_a']  = {'variations': top_varations_won_a, 'distribution': distr_won_a}
-        self.metrics['outcomes_won_b']  = {'variations': top_varations_won_b, 'distribution': distr_won_b}
-        self.metrics['outcomes_draw_a'] = {'variations': top_varations_draw_a, 'distribution': distr_draw_a}
-        self.metrics['outcomes_draw_b'] = {'variations': top_varations_draw_b, 'distribution': distr_draw_b}
+            for key, side, outcome in [('outcomes_won_a', 'A', 1), ('outcomes_won_b', 'B', 0),
+                                       ('outcomes_draw_a', 'A', 2), ('outcomes_draw_b', 'B', 2)]:
+                variations, distribution = agg.top_variations(side, outcome, self.battle_type)
+                self.metrics[key] = {'variations': variations, 'distribution': distribution}
 
 
 
@@ -411,7 +1009,7 @@ class Simulate:
             str += f"{'AIR Red':<10}"
             buf.write(str+os.linesep)
             return buf.getvalue()
-        N = self.cur_n+1
+        N = self.metrics['n']
         report.write(f"Results:{os.linesep}")
         report.write(f"{'A Won:':<20}{games_won_a / N:.2f}{os.linesep}")
         report.write(f"{'B Won:':<20}{games_won_b / N:.2f}{os.linesep}") 
@@ -499,7 +1097,7 @@ class Simulate:
             buf.write(str+os.linesep)
             return buf.getvalue()
 
-        N = self.cur_n+1
+        N = self.metrics['n']
         report.write("--------------------------------------------------------------"+os.linesep)
         report.write(f"Results:{os.linesep}")
         report.write(f"{'A Won:':<20}{games_won_a / N:.2f}{os.linesep}")
@@ -0,0 +1,98 @@
+import numpy as np
+
+
+class TrialBuffer:
+    '''
+        results of the trials of a simulation in preallocated arrays
+            status                  (n,) uint8 - returncode of Battle.run
+            survivors[side][type]   (n, color) int8 - units left after the battle
+            weights                 (n,) float - weight of each trial, None while all are 1
+        reserve allocates room for a known number of trials up front, beyond
+        that the arrays grow by chunk trials at a time
+    '''
+    def __init__(self, capacity: int = 0, chunk: int = 4096):
+        self.n = 0
+        self.chunk = chunk
+        self._status = np.zeros(capacity, dtype=np.uint8)
+        self._survivors = {side: {type: np.zeros((capacity, 5), dtype=np.int8) for type in ['land', 'air', 'sea']}
+                           for side in ['A', 'B']}
+        self._weights = None
+
+
+    def __len__(self):
+        return self.n
+
+
+    @property
+    def capacity(self) -> int:
+        return len(self._status)
+
+
+    @property
+    def status(self) -> np.ndarray:
+        return self._status[:self.n]
+
+
+    @property
+    def weights(self):
+        return None if self._weights is None else self._weights[:self.n]
+
+
+    @property
+    def survivors(self):
+        return {side: {type: units[:self.n] for type, units in s.items()} for side, s in self._survivors.items()}
+
+
+    def reserve(self, n: int) -> None:
+        ''' makes room for n more trials '''
+        needed = self.n + n
+        if needed <= self.capacity:
+            return
+        capacity = max(needed, self.capacity + self.chunk)
+
+        status = np.zeros(capacity, dtype=np.uint8)
+        status[:self.n] = self.status
+        self._status = status
+        if self._weights is not None:
+            weights = np.ones(capacity)
+            weights[:self.n] = self.weights
+            self._weights = weights
+        for s in self._survivors.values():
+            for type, units in s.items():
+                s[type] = np.zeros((capacity, 5), dtype=np.int8)
+                s[type][:self.n] = units[:self.n]
+
+
+    def add(self, status: int, armies) -> None:
+        ''' appends one trial - armies are the armies of the finished battle by side '''
+        self.reserve(1)
+        self._status[self.n] = status
+        if self._weights is not None:
+            self._weights[self.n] = 1
+        for side, army in armies.items():
+            for type, units in self._survivors[side].items():
+                units[self.n] = army.units[type]
+            if army.submerged > 0:
+                self._survivors[side]['sea'][self.n, 0] += army.submerged
+        self.n += 1
+
+
+    def extend(self, status: np.ndarray, survivors, weights=None) -> None:
+        ''' appends a block of trials - survivors[side][type] (n, color), weights (n,) '''
+        n = len(status)
+        self.reserve(n)
+        self._status[self.n:self.n + n] = status
+        if weights is not None and self._weights is None:
+            self._weights = np.ones(self.capacity)
+        if self._weights is not None:
+            self._weights[self.n:self.n + n] = 1 if weights is None else weights
+        for side, s in survivors.items():
+            for type, units in s.items():
+                self._survivors[side][type][self.n:self.n + n] = units
+        self.n += n
+
+
+    def clear(self) -> None:
+        ''' drops all trials but keeps the allocated arrays '''
+        self.n = 0
+        self._weights = None
@@ -0,0 +1,44 @@
+import os
+
+# package root and the source tree around it (version file, .git) if installed from a checkout
+_here = os.path.dirname(os.path.abspath(__file__))
+_root = os.path.dirname(_here)
+
+
+def _read_version() -> str:
+    ''' version file of the source tree, the installed package metadata otherwise '''
+    path = os.path.join(_root, 'version')
+    if os.path.exists(path):
+        with open(path) as f:
+            return f.read().strip()
+    from importlib import metadata
+    try:
+        return metadata.version('WRDice')
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def _read_git_sha():
+    ''' commit of the source tree read from .git directly - None outside a checkout '''
+    git_dir = os.path.join(_root, '.git')
+    try:
+        with open(os.path.join(git_dir, 'HEAD')) as f:
+            head = f.read().strip()
+        if not head.startswith('ref: '):
+            return head
+        ref = head[len('ref: '):]
+        if os.path.exists(os.path.join(git_dir, ref)):
+            with open(os.path.join(git_dir, ref)) as f:
+                return f.read().strip()
+        with open(os.path.join(git_dir, 'packed-refs')) as f:
+            for line in f:
+                if line.rstrip().endswith(' ' + ref):
+                    return line.split()[0]
+    except OSError:
+        pass
+    return None
+
+
+# resolved once at import
+__version__ = _read_version()
+__git_sha__ = _read_git_sha()
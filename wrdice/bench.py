@@ -0,0 +1,233 @@
+'''
+    benchmark of the battle engines over a fixed matrix of scenarios
+        python -m wrdice.bench [--quick] [--output results.json] [--baseline benchmarks/baseline.json]
+    times Battle.run per trial, Simulate.run per backend, eval_statistics and get_report
+    and prints the results as JSON - with a baseline, throughput that drops by more
+    than the tolerance is reported as a regression and the exit code is 1
+'''
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import wrdice
+from wrdice.Army import Army
+from wrdice.Battle import Battle
+from wrdice.Simulate import Simulate
+from wrdice.config import wr20_vaniilla_config
+from wrdice.util import Backend, CombatSystem
+
+NO_UNITS = [0, 0, 0, 0, 0]
+ALL_UNITS = [-1, -1, -1, -1, -1]
+
+# units (land, air, sea) and stances (land, air, sea) of both sides
+SCENARIOS = {
+    'land': (([5, 3, 2, 0, 0], NO_UNITS, NO_UNITS, [[-1, 0, -1, 0, 0], [0, -1, 0, 0, 0]], [NO_UNITS, ALL_UNITS], [NO_UNITS, ALL_UNITS]),
+             ([5, 2, 3, 0, 0], NO_UNITS, NO_UNITS, [[-1, 0, -1, 0, 0], [0, -1, 0, 0, 0]], [NO_UNITS, ALL_UNITS], [ALL_UNITS, NO_UNITS])),
+    'air': (([3, 2, 0, 0, 0], [0, 0, 6, 4, 0], NO_UNITS, [NO_UNITS, ALL_UNITS], [[0, 0, 4, 2, 0], [0, 0, 2, 2, 0]], [NO_UNITS, ALL_UNITS]),
+            ([4, 1, 1, 0, 0], [0, 0, 5, 5, 0], NO_UNITS, [ALL_UNITS, NO_UNITS], [[0, 0, 3, 3, 0], [0, 0, 2, 2, 0]], [NO_UNITS, ALL_UNITS])),
+    'sea': ((NO_UNITS, [0, 0, 2, 1, 0], [2, 3, 2, 1, 0], [NO_UNITS, ALL_UNITS], [ALL_UNITS, NO_UNITS], [[0, 2, 0, 0, 0], [-1, 1, -1, -1, 0]]),
+            (NO_UNITS, [0, 0, 2, 0, 0], [3, 2, 2, 2, 0], [NO_UNITS, ALL_UNITS], [NO_UNITS, ALL_UNITS], [[0, 1, 0, 0, 0], [-1, 1, -1, -1, 0]])),
+    'capped': (([12, 8, 6, 0, 0], [0, 0, 6, 4, 0], NO_UNITS, [[0, 3, 2, 0, 0], [-1, 5, 4, 0, 0]], [[0, 0, 2, 2, 0], [0, 0, 4, 2, 0]], [NO_UNITS, ALL_UNITS]),
+               ([14, 7, 6, 0, 0], [0, 0, 5, 5, 0], NO_UNITS, [[4, 2, 0, 0, 0], [10, 5, 6, 0, 0]], [NO_UNITS, ALL_UNITS], [NO_UNITS, ALL_UNITS])),
+}
+
+# (stage, metric) compared to the baseline and whether higher is better
+TRACKED = [('battle_run', 'battles_per_s', True),
+           ('simulate_scalar', 'battles_per_s', True),
+           ('simulate_vectorized', 'battles_per_s', True),
+           ('eval_statistics', 'ms', False),
+           ('get_report', 'ms', False)]
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'baseline.json')
+
+
+def make_armies(name: str, config=wr20_vaniilla_config):
+    armies = []
+    for land, air, sea, stance_land, stance_air, stance_sea in SCENARIOS[name]:
+        army = Army(land, air, sea, config)
+        army.apply_stance(stance_land, stance_air, stance_sea)
+        armies.append(army)
+    return armies
+
+
+def percentiles(samples_s) -> dict:
+    p50, p90, p99 = np.percentile(samples_s, [50, 90, 99]) * 1e6
+    return {'p50_us': round(p50, 1), 'p90_us': round(p90, 1), 'p99_us': round(p99, 1)}
+
+
+def bench_battle_run(army_a: Army, army_b: Army, combat_system: CombatSystem, config, n: int, warmup: int = 20) -> dict:
+    ''' single Battle.run calls from the same armies - per trial latency '''
+    rng = np.random.default_rng(0)
+    snapshot_a, snapshot_b = army_a.snapshot(), army_b.snapshot()
+    samples = np.zeros(n + warmup)
+    for i in range(n + warmup):
+        army_a.restore(snapshot_a)
+        army_b.restore(snapshot_b)
+        start = time.perf_counter()
+        Battle(army_a, army_b, config, rng).run(combat_system=combat_system)
+        samples[i] = time.perf_counter() - start
+    # the first battles build the dice tables
+    samples = samples[warmup:]
+    army_a.restore(snapshot_a)
+    army_b.restore(snapshot_b)
+    # the median is robust against the scheduler, the tail is in the percentiles
+    return {'battles_per_s': round(1 / np.median(samples), 1), **percentiles(samples)}
+
+
+def best_of(f, calls: int) -> float:
+    ''' shortest of calls calls of f in seconds '''
+    best = np.inf
+    for _ in range(calls):
+        start = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_simulate(army_a: Army, army_b: Army, combat_system: CombatSystem, config, backend: Backend, n: int,
+                   repeat: int, calls: int = 20):
+    '''
+        Simulate.run best of repeat runs, eval_statistics and get_report best of calls
+        calls on each run -> (run, {stage: ms})
+    '''
+    times = {'run': [], 'eval_statistics': [], 'get_report': []}
+    battles = 0
+    for seed in range(repeat):
+        sim = Simulate(army_a, army_b, config, rng=seed)
+        sim.N = n
+        start = time.perf_counter()
+        sim.run(combat_system, config, backend=backend)
+        times['run'].append(time.perf_counter() - start)
+        # the scalar loop may stop early once the estimates settled
+        battles = len(sim.trials)
+
+        times['eval_statistics'].append(best_of(sim.eval_statistics, calls))
+        times['get_report'].append(best_of(sim.get_report, calls))
+
+    run = min(times['run'])
+    result = {'battles': battles, 'battles_per_s': round(battles / run, 1), 'ms': round(run * 1000, 2),
+              'per_trial_us': round(run / battles * 1e6, 2)}
+    return result, {stage: round(min(t) * 1000, 2) for stage, t in times.items() if stage != 'run'}
+
+
+def peak_memory(army_a: Army, army_b: Army, combat_system: CombatSystem, config, backend: Backend, n: int) -> int:
+    ''' peak python heap of one simulation and its statistics in KiB '''
+    tracemalloc.start()
+    try:
+        sim = Simulate(army_a, army_b, config, rng=0)
+        sim.N = n
+        sim.run(combat_system, config, backend=backend)
+        sim.eval_statistics()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak // 1024
+
+
+def run_benchmarks(scenarios, combat_system: CombatSystem = CombatSystem.WarRoomV2, n_battle: int = 500,
+                   n_scalar: int = 2500, n_vectorized: int = 50000, repeat: int = 3) -> dict:
+    config = wr20_vaniilla_config
+    results = {}
+    for name in scenarios:
+        army_a, army_b = make_armies(name, config)
+        scenario = {'battle_run': bench_battle_run(army_a, army_b, combat_system, config, n_battle)}
+        for backend, n in [(Backend.Scalar, n_scalar), (Backend.Vectorized, n_vectorized)]:
+            key = f'simulate_{backend.name.lower()}'
+            scenario[key], stats = bench_simulate(army_a, army_b, combat_system, config, backend, n, repeat)
+            scenario[key]['peak_kib'] = peak_memory(army_a, army_b, combat_system, config, backend, n)
+            if backend == Backend.Vectorized:
+                # statistics of the large vectorized run
+                scenario['eval_statistics'] = {'ms': stats['eval_statistics']}
+                scenario['get_report'] = {'ms': stats['get_report']}
+        results[name] = scenario
+
+    return {'meta': {'version': wrdice.__version__,
+                     'git_sha': wrdice.__git_sha__,
+                     'combat_system': combat_system.name,
+                     'python': platform.python_version(),
+                     'numpy': np.__version__,
+                     'machine': platform.machine(),
+                     'n': {'battle_run': n_battle, 'scalar': n_scalar, 'vectorized': n_vectorized, 'repeat': repeat}},
+            'results': results}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    '''
+        tracked metrics that are worse than the baseline by more than tolerance
+        -> [{scenario, stage, metric, baseline, current, change}]
+    '''
+    regressions = []
+    for name, scenario in results['results'].items():
+        for stage, metric, higher_is_better in TRACKED:
+            try:
+                before = baseline['results'][name][stage][metric]
+            except KeyError:
+                continue
+            current = scenario[stage][metric]
+            change = (current - before) / before if before else 0.0
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append({'scenario': name, 'stage': stage, 'metric': metric,
+                                    'baseline': before, 'current': current, 'change': round(change, 3)})
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m wrdice.bench', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--combat-system', choices=[c.name for c in CombatSystem], default=CombatSystem.WarRoomV2.name)
+    parser.add_argument('--quick', action='store_true', help='a tenth of the trials - smoke test, noisy')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the JSON here instead of stdout')
+    parser.add_argument('--baseline', default=None,
+                        help=f'baseline JSON to compare with (default {os.path.relpath(DEFAULT_BASELINE)} if present)')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative slowdown reported as regression')
+    args = parser.parse_args(argv)
+
+    scale = 10 if args.quick else 1
+    logging.disable(logging.WARNING)
+    # the scalar loop shows a progress bar - keep the output clean
+    with contextlib.redirect_stderr(io.StringIO()):
+        results = run_benchmarks(args.scenarios, CombatSystem[args.combat_system], n_battle=500 // scale,
+                                 n_scalar=2500 // scale, n_vectorized=50000 // scale, repeat=args.repeat)
+
+    baseline_path = args.baseline or DEFAULT_BASELINE
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(baseline_path)), exist_ok=True)
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+    elif os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        results['baseline'] = {'path': baseline_path, 'tolerance': args.tolerance,
+                               'regressions': compare(results, baseline, args.tolerance)}
+    elif args.baseline is not None:
+        parser.error(f'baseline {args.baseline} does not exist')
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    regressions = results.get('baseline', {}).get('regressions', [])
+    for r in regressions:
+        print(f"regression {r['scenario']} {r['stage']} {r['metric']}: {r['baseline']} -> {r['current']} ({r['change']:+.0%})",
+              file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
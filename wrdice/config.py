@@ -1,5 +1,6 @@
 import numpy as np
 from wrdice.util import ColorSelectionStrategy
+from wrdice.CombatConfig import CombatConfig
 
 
 '''
@@ -132,3 +133,7 @@ arewethebaddies_options = {
 
 }
 
+
+# compiled once - the engines take these directly
+wr20_vaniilla_config = CombatConfig(wr20_vaniilla_options)
+arewethebaddies_config = CombatConfig(arewethebaddies_options)
@@ -1,4 +1,5 @@
 from enum import Enum, IntEnum, auto
+from math import exp, lgamma, log, log1p, sqrt
 import numpy as np
 
 
@@ -24,16 +25,224 @@ class CombatSystem(Enum):
     WarRoomV2Quickbattle = auto()
     AreWeTheBaddies = auto()
 
+class Backend(Enum):
+    Scalar = auto()
+    Vectorized = auto()
+    Exact = auto()
+
+class Sampler(Enum):
+    MonteCarlo = auto()
+    # first air and ground batch stratified over their outcomes
+    Stratified = auto()
+    # trials in pairs rolled from uniforms u and 1 - u
+    Antithetic = auto()
+
+class Interval(Enum):
+    Wilson = auto()
+    ClopperPearson = auto()
+
 class Strategy(Enum):
     BlackToHighestValueFirst = auto()
     BlackToGroundFirst = auto()
     GenerateWhite = auto()
     ShadowywzsStrategy = auto()
 
+def progress_bar(iterable):
+    ''' tqdm progress bar over iterable - tqdm is imported on first use and optional '''
+    try:
+        from tqdm import tqdm
+    except ImportError:
+        return iterable
+    return tqdm(iterable)
+
 def ListToNumpy(x):
     if isinstance(x, list):
         return np.asarray(x)
     else:
         return x
 
-       
\ No newline at end of file
+       
+
+
+def drain_hits(pool, hits):
+    '''
+        spreads hits over the last axis of pool in order - each entry is emptied
+        before the next one takes damage
+        pool[..., k], hits[...] -> (remaining pool, unused hits)
+    '''
+    hits = np.asarray(hits)
+    before = np.cumsum(pool, axis=-1) - pool
+    taken = np.clip(hits[..., None] - before, 0, pool)
+    return pool - taken, hits - taken.sum(axis=-1)
+
+
+def drain_escorted_hits(pool, hits, escort, unit_hp):
+    '''
+        drain_hits for a single pool of ships - hits on the last hp of a ship are
+        soaked by the escort pool as long as it has hp left
+        -> (remaining pool, remaining escort, unused hits)
+    '''
+    if unit_hp == 0:
+        taken = np.minimum(hits, pool)
+        return pool - taken, escort, hits - taken
+
+    # damage until the next hit would sink a ship
+    to_last = np.where(pool > 0, np.minimum(hits, (pool - 1) % unit_hp), 0)
+    pool = pool - to_last
+    hits = hits - to_last
+
+    soaked = np.where(pool % unit_hp == 1, np.minimum(hits, escort), 0)
+    escort = escort - soaked
+    hits = hits - soaked
+
+    taken = np.minimum(hits, pool)
+    return pool - taken, escort, hits - taken
+
+
+def split_quick_hits(roll, unit_hp):
+    '''
+        quickbattle roll on units with unit_hp[color] - every unit_hp dice of a color
+        kill one unit of that color, the white dice are wild
+        roll[..., face] -> (hits[..., color], unmatched dice[..., color], wild[...])
+    '''
+    roll = np.asarray(roll).astype(int)
+    dice = roll[..., :COLOR.WHITE]
+    hits = np.floor_divide(dice, unit_hp, out=np.zeros_like(dice), where=unit_hp != 0)
+    return hits, dice - hits * unit_hp, roll[..., COLOR.WHITE]
+
+
+def apply_wild_hit(units, unmatched, wild):
+    '''
+        a wild die completes the unmatched dice of the highest color the target still
+        has and kills one unit of it - at most one per roll
+        units[..., color] -> units
+    '''
+    targets = (unmatched > 0) & (units > 0) & (np.asarray(wild) > 0)[..., None]
+    n_colors = targets.shape[-1]
+    color = n_colors - 1 - np.argmax(targets[..., ::-1], axis=-1)
+    killed = (np.arange(n_colors) == color[..., None]) & targets.any(axis=-1)[..., None]
+    return units - killed
+
+
+def color_selection_mask(strategy: ColorSelectionStrategy, expected, units, num_colors, morale):
+    '''
+        colors whose hits are dropped by color selection - a side can only select as
+        many target colors as it brings into the fight, the hits on all others are lost
+        expected[..., color] expected hits of a batch on units[..., color] of the target,
+        num_colors[...] colors of the source -> mask[..., color]
+    '''
+    colors = np.arange(expected.shape[-1])
+    num_colors = np.asarray(num_colors)[..., None]
+
+    def select_best(score):
+        # the num_colors colors with the highest score, ties go to the more valuable color
+        order = np.lexsort((np.broadcast_to(-colors, score.shape), -score), axis=-1)
+        rank = np.argsort(order, axis=-1)
+        return rank < num_colors
+
+    if strategy == ColorSelectionStrategy.MAX_NUM_HITS_FIRST:
+        return ~select_best(expected)
+    most_morale = select_best(expected * morale)
+    if strategy == ColorSelectionStrategy.MAX_MORALE_LOST_FIRST:
+        return ~most_morale
+
+    # colors that can be wiped out, max morale if there are none
+    reducible = (units - expected <= 0) & (units > 0)
+    return np.where(reducible.any(axis=-1, keepdims=True), ~reducible, ~most_morale)
+
+
+def drain_damaged_hits(pool, hits, unit_hp):
+    '''
+        drain_hits that only finishes off damaged units - each entry takes at most
+        pool % unit_hp hits
+    '''
+    damaged = np.mod(pool, unit_hp, out=np.zeros_like(pool), where=unit_hp != 0)
+    remaining, hits = drain_hits(damaged, hits)
+    return pool - damaged + remaining, hits
+
+
+def beta_cdf(x, a, b):
+    '''
+        regularized incomplete beta function I_x(a, b) - continued fraction
+        (modified Lentz), converges in O(sqrt(max(a, b))) steps
+    '''
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    if x > (a + 1) / (a + b + 2):
+        # the fraction converges fast below the mean only
+        return 1.0 - beta_cdf(1.0 - x, b, a)
+
+    tiny = 1e-300
+    front = exp(lgamma(a + b) - lgamma(a) - lgamma(b) + a * log(x) + b * log1p(-x)) / a
+    c = 1.0
+    d = 1.0 - (a + b) * x / (a + 1)
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    f = d
+    for m in range(1, 100000):
+        for num in (m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+                    -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))):
+            d = 1.0 + num * d
+            d = 1.0 / (d if abs(d) > tiny else tiny)
+            c = 1.0 + num / c
+            c = c if abs(c) > tiny else tiny
+            f *= c * d
+        if abs(c * d - 1.0) < 1e-15:
+            break
+    return front * f
+
+
+def beta_quantile(q, a, b):
+    ''' x with I_x(a, b) = q - newton steps on beta_cdf, bisection where they leave the bracket '''
+    log_norm = lgamma(a + b) - lgamma(a) - lgamma(b)
+    lo, hi = 0.0, 1.0
+    # start from the normal approximation
+    mean = a / (a + b)
+    sd = sqrt(a * b / (a + b + 1)) / (a + b)
+    from statistics import NormalDist
+    x = min(max(mean + NormalDist().inv_cdf(q) * sd, 1e-12), 1 - 1e-12)
+    for _ in range(200):
+        err = beta_cdf(x, a, b) - q
+        if err > 0:
+            hi = x
+        else:
+            lo = x
+        pdf = exp(log_norm + (a - 1) * log(x) + (b - 1) * log1p(-x))
+        step = x - err / pdf if pdf > 0 else -1.0
+        step = step if lo < step < hi else (lo + hi) / 2
+        if abs(step - x) <= 1e-10 * x or hi - lo <= 1e-15:
+            return step
+        x = step
+    return x
+
+
+def binomial_interval(k, n, confidence=0.95, method: Interval = Interval.Wilson):
+    '''
+        two sided confidence interval for the probability of an outcome seen k
+        out of n times - k may be an array
+        -> (low, high)
+    '''
+    k = np.asarray(k, dtype=float)
+    if n == 0:
+        return np.zeros_like(k), np.ones_like(k)
+    alpha = 1 - confidence
+
+    if method == Interval.Wilson:
+        from statistics import NormalDist
+        z = NormalDist().inv_cdf(1 - alpha / 2)
+        p = k / n
+        center = (p + z**2 / (2 * n)) / (1 + z**2 / n)
+        half = z / (1 + z**2 / n) * np.sqrt(p * (1 - p) / n + z**2 / (4 * n**2))
+        return np.maximum(0, center - half), np.minimum(1, center + half)
+
+    # Clopper-Pearson - quantiles of the beta distribution
+    n = int(round(n))
+    low = np.zeros_like(k)
+    high = np.ones_like(k)
+    for idx, x in np.ndenumerate(np.rint(k).astype(int)):
+        if x > 0:
+            low[idx] = beta_quantile(alpha / 2, x, n - x + 1)
+        if x < n:
+            high[idx] = beta_quantile(1 - alpha / 2, x + 1, n - x)
+    return low, high